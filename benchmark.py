@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+"""
+Offline load benchmark for the Smart AC Agent.
+
+Starts ACAgentHandler in-process alongside local stand-ins for OpenAI chat completions,
+IFTTT maker webhooks and LangSmith runs (each with configurable latency and error
+injection), replays synthetic GPS commute traces at a controlled concurrency and reports
+throughput and p50/p95/p99 latency per endpoint. No network access or API keys needed.
+With --ingest ha the fixes are pushed as state_changed events by a fake Home Assistant
+WebSocket API instead of being POSTed.
+
+    python benchmark.py --devices 50 --pings 40 --concurrency 16 --llm-latency-ms 400
+    python benchmark.py --ingest ha --ha-drop-every 50
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+# Fake external services
+class FakeService:
+    """Latency/error settings and call counters for one fake upstream."""
+
+    def __init__(self, name, latency_ms=0, jitter=0.2, error_rate=0.0, tail_rate=0.0, tail_ms=0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tail_rate = tail_rate  # Share of calls that take tail_ms instead, like a stalled upstream
+        self.tail_ms = tail_ms
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.prefixes = set()
+
+    def simulate(self):
+        """Sleep for the configured latency; return True if this call should fail."""
+        with self.lock:
+            self.calls += 1
+        latency_ms = self.tail_ms if random.random() < self.tail_rate else self.latency_ms
+        if latency_ms:
+            time.sleep(latency_ms / 1000 * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return True
+        return False
+
+    def cached_prefix_tokens(self, prefix_messages, min_tokens=1024, increment=128):
+        """Mimic OpenAI prompt caching: a repeated prefix of >= 1024 tokens hits in 128-token steps."""
+        prefix = json.dumps(prefix_messages)
+        with self.lock:
+            seen = prefix in self.prefixes
+            self.prefixes.add(prefix)
+        tokens = len(prefix) // 4
+        return tokens // increment * increment if seen and tokens >= min_tokens else 0
+
+def fake_llm_decision(prompt):
+    """Answer the way the agent instructions say to, so actions in the benchmark look realistic."""
+    distance = re.search(r"Distance from home: ([\d.]+)", prompt)
+    trend = re.search(r"Movement trend: (\w+)", prompt)
+    distance = float(distance.group(1)) if distance else 0.0
+    trend = trend.group(1) if trend else "unknown"
+    if distance < 0.25:
+        return "no_action"
+    if distance <= 2 and trend == "approaching":
+        return "ac_on"
+    if distance > 2 or trend == "moving_away":
+        return "ac_off"
+    return "no_action"
+
+def make_fake_handler(services):
+    class FakeUpstreamHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like the real services
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.endswith("/chat/completions"):
+                service = services["openai"]
+            elif self.path.startswith("/trigger/"):
+                service = services["ifttt"]
+            elif self.path.startswith("/runs"):
+                service = services["langsmith"]
+            else:
+                self.respond(404, {"error": "unknown path"})
+                return
+
+            if service.simulate():
+                self.respond(503, {"error": f"injected {service.name} failure"})
+                return
+
+            if service.name == "openai":
+                request = json.loads(body or b"{}")
+                messages = request.get("messages", [])
+                prompt = "\n".join(m.get("content", "") for m in messages)
+                decision = fake_llm_decision(prompt)
+                if request.get("response_format"):
+                    decision = json.dumps({"action": decision})
+                prompt_tokens = len(prompt) // 4
+                cached_tokens = service.cached_prefix_tokens(messages[:-1])
+                self.respond(200, {
+                    "choices": [{"message": {"content": decision}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 2,
+                              "total_tokens": prompt_tokens + 2,
+                              "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+                })
+            elif service.name == "ifttt":
+                self.respond(200, {"message": "Congratulations! You've fired the event"})
+            else:
+                self.respond(200, {})
+
+        do_PATCH = do_POST
+
+        def respond(self, status, payload):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeUpstreamHandler
+
+class FakeHomeAssistant:
+    """Home Assistant's WebSocket API, reduced to auth, subscribe_events, ping and pushed state_changed events."""
+
+    def __init__(self, token="bench", drop_every=0):
+        self.token = token
+        self.drop_every = drop_every  # Close each connection after this many events, to exercise reconnects
+        self.cond = threading.Condition()
+        self.subscribers = {}  # connection -> subscription id
+        self.connections = 0
+        self.events = 0
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                # Like Home Assistant's aiohttp server, so back-to-back events aren't held for delayed ACKs
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                fake.serve(self.connection, self.rfile)
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"ws://127.0.0.1:{self.server.server_address[1]}/api/websocket"
+
+    @staticmethod
+    def send(connection, message):
+        data = json.dumps(message).encode()
+        length = len(data)
+        header = struct.pack("!BB", 0x81, length) if length < 126 else struct.pack("!BBH", 0x81, 126, length)
+        connection.sendall(header + data)
+
+    @staticmethod
+    def receive(rfile):
+        """Next client text message (masked frames), or None once the client closes or resets."""
+        while True:
+            try:
+                head = rfile.read(2)
+                if len(head) < 2:
+                    return None
+                opcode, length = head[0] & 0x0F, head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", rfile.read(8))[0]
+                mask = rfile.read(4) if head[1] & 0x80 else b"\0\0\0\0"
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(rfile.read(length)))
+            except OSError:
+                # The client reconnecting after a dropped connection may reset it
+                return None
+            if opcode == 0x8:
+                return None
+            if opcode == 0x1:
+                return json.loads(payload)
+
+    def serve(self, connection, rfile):
+        request = b""
+        while not request.endswith(b"\r\n\r\n"):
+            line = rfile.readline()
+            if not line:
+                return
+            request += line
+        key = re.search(rb"Sec-WebSocket-Key: *(\S+)", request, re.I).group(1).decode()
+        accept = base64.b64encode(hashlib.sha1((key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest())
+        connection.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                           b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        self.send(connection, {"type": "auth_required", "ha_version": "2025.1.0"})
+        auth = self.receive(rfile)
+        if not auth or auth.get("access_token") != self.token:
+            self.send(connection, {"type": "auth_invalid", "message": "Invalid access token"})
+            return
+        self.send(connection, {"type": "auth_ok", "ha_version": "2025.1.0"})
+        with self.cond:
+            self.connections += 1
+        try:
+            while True:
+                message = self.receive(rfile)
+                if message is None:
+                    return
+                if message.get("type") == "subscribe_events":
+                    with self.cond:
+                        self.send(connection, {"id": message["id"], "type": "result", "success": True, "result": None})
+                        self.subscribers[connection] = message["id"]
+                        self.cond.notify_all()
+                elif message.get("type") == "ping":
+                    with self.cond:
+                        self.send(connection, {"id": message["id"], "type": "pong"})
+        finally:
+            with self.cond:
+                self.subscribers.pop(connection, None)
+
+    def push(self, entity_id, old_attributes, new_attributes, timeout=30):
+        """Send a state_changed event to every subscriber, waiting for one if a reconnect is under way."""
+        event = {"event_type": "state_changed", "time_fired": datetime.now(timezone.utc).isoformat(),
+                 "data": {"entity_id": entity_id,
+                          "old_state": {"entity_id": entity_id, "state": "not_home", "attributes": old_attributes},
+                          "new_state": {"entity_id": entity_id, "state": "not_home", "attributes": new_attributes}}}
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.subscribers, timeout):
+                raise TimeoutError("no Home Assistant WebSocket subscriber")
+            self.events += 1
+            drop = self.drop_every and self.events % self.drop_every == 0
+            for connection, subscription in list(self.subscribers.items()):
+                self.send(connection, {"id": subscription, "type": "event", "event": event})
+                if drop:
+                    del self.subscribers[connection]
+                    connection.shutdown(socket.SHUT_RDWR)
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+# Synthetic commute traces
+def commute_trace(home, pings, start_miles, speed_mph, interval_s, rng):
+    """Fixes for a drive straight toward home from start_miles out, one every interval_s."""
+    bearing = rng.uniform(0, 2 * math.pi)
+    fixes = []
+    for i in range(pings):
+        miles = max(start_miles - speed_mph * interval_s * i / 3600, 0.0)
+        # Small GPS jitter on top of the straight-line approach
+        miles += rng.gauss(0, 0.005)
+        dlat = miles * math.cos(bearing) / 69.0
+        dlon = miles * math.sin(bearing) / (69.0 * math.cos(math.radians(home[0])))
+        fixes.append({"lat": home[0] + dlat, "lon": home[1] + dlon, "speed_mph": speed_mph})
+    return fixes
+
+# Load generation
+class LatencyRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+def drive_device(base_url, device_id, fixes, batch_size, recorder):
+    session = requests.Session()
+
+    def post(endpoint, payload):
+        start = time.perf_counter()
+        try:
+            response = session.post(base_url + endpoint, json=payload, timeout=60)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        recorder.record(endpoint, time.perf_counter() - start, ok)
+
+    # Catch-up after a connectivity gap arrives as one batch, the rest as live pings
+    if batch_size:
+        now = time.time()
+        backlog = fixes[:batch_size]
+        batch = [dict(fix, timestamp=now - (len(backlog) - i)) for i, fix in enumerate(backlog)]
+        post("/ping/batch", {"device_id": device_id, "fixes": batch})
+        fixes = fixes[batch_size:]
+
+    for fix in fixes:
+        post("/ping", dict(fix, device_id=device_id))
+
+def drive_ha_device(fake, entity_id, fixes, recorder, processed):
+    """Push each fix as a state_changed event and time it until process_ping has finished with it."""
+    previous = {}
+    for fix in fixes:
+        attributes = {"latitude": fix["lat"], "longitude": fix["lon"], "speed": fix["speed_mph"] / 2.23694,
+                      "gps_accuracy": 10}
+        done = processed[(fix["lat"], fix["lon"])] = threading.Event()
+        start = time.perf_counter()
+        fake.push(entity_id, previous, attributes)
+        ok = done.wait(60)
+        recorder.record("ha_websocket", time.perf_counter() - start, ok)
+        previous = attributes
+
+def micro_benchmark(agent_main, pings):
+    """Per-ping cost of parse -> process_ping -> serialize with no upstreams, plus one device's history memory."""
+    home = agent_main.HOME
+    bodies = [json.dumps({"lat": home[0] + 0.03 + i * 1e-6, "lon": home[1], "speed_mph": 20,
+                          "device_id": f"micro-{i % 100}"}).encode() for i in range(pings)]
+    for body in bodies[:500]:
+        agent_main.json_dumps(agent_main.process_ping(agent_main.json_loads(body)))
+    start = time.perf_counter()
+    for body in bodies:
+        agent_main.json_dumps(agent_main.process_ping(agent_main.json_loads(body)))
+    per_ping_us = (time.perf_counter() - start) / pings * 1e6
+
+    tracemalloc.start()
+    transient = 0
+    for body in bodies[:2000]:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        agent_main.json_dumps(agent_main.process_ping(agent_main.json_loads(body)))
+        transient += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    state = agent_main.device_store.get(agent_main.DEFAULT_HOME_ID, "micro-history")
+    for i in range(pings):
+        agent_main.record_location(state, (home[0] + i * 1e-6, home[1]), 20)
+    history_bytes, history_fixes = state.history.nbytes(), len(state.history)
+
+    zones, zone_us = zone_benchmark(agent_main, pings)
+    report = {"pings": pings, "per_ping_us": per_ping_us, "transient_bytes_per_ping": transient / min(pings, 2000),
+              "history_bytes": history_bytes, "history_fixes": history_fixes, "json_codec": "orjson" if agent_main.orjson else "json",
+              "zones": zones, "zone_lookup_us": zone_us}
+    print(f"\n🔬 Ping path microbenchmark ({pings} pings, rules mode, {report['json_codec']}):")
+    print(f"   {per_ping_us:.1f} µs/ping, {report['transient_bytes_per_ping']:.0f} B allocated at peak per ping, "
+          f"{history_bytes} B of history held for one device after {pings} fixes ({history_fixes} kept)")
+    print(f"   {zone_us:.2f} µs per zone lookup across {zones} zones")
+    return report
+
+def zone_benchmark(agent_main, lookups, homes=500, seed=1):
+    """Zone lookups against many homes, each with concentric rings and a few small polygons."""
+    rng = random.Random(seed)
+    config = {}
+    for h in range(homes):
+        lat, lon = rng.uniform(25, 48), rng.uniform(-120, -75)
+        zones = [{"name": f"stop{k}", "type": "polygon", "action": "ac_off",
+                  "points": [[lat + dy, lon + dx], [lat + dy, lon + dx + 0.005],
+                             [lat + dy + 0.005, lon + dx + 0.005], [lat + dy + 0.005, lon + dx]]}
+                 for k, (dy, dx) in enumerate((rng.uniform(-0.1, 0.1), rng.uniform(-0.1, 0.1)) for _ in range(4))]
+        zones += [{"name": "home", "type": "ring", "outer_mi": 0.25, "action": "no_action"},
+                  {"name": "near", "type": "ring", "inner_mi": 0.25, "outer_mi": 3, "action": "ac_on", "when": "approaching"},
+                  {"name": "far", "type": "ring", "inner_mi": 3, "outer_mi": 15, "action": "ac_off"}]
+        config[f"home{h}"] = {"lat": lat, "lon": lon, "zones": zones}
+    index = agent_main.ZoneIndex(config)
+    queries = [(home_id, home["lat"] + rng.uniform(-0.25, 0.25), home["lon"] + rng.uniform(-0.25, 0.25))
+               for home_id, home in (rng.choice(list(config.items())) for _ in range(lookups))]
+    start = time.perf_counter()
+    for home_id, lat, lon in queries:
+        index.lookup(home_id, lat, lon)
+    return index.zones, (time.perf_counter() - start) / lookups * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load benchmark for the Smart AC Agent")
+    parser.add_argument("--devices", type=int, default=20, help="Simulated phones (one commute trace each)")
+    parser.add_argument("--pings", type=int, default=30, help="Pings per device trace")
+    parser.add_argument("--concurrency", type=int, default=8, help="Devices driven in parallel")
+    parser.add_argument("--batch-size", type=int, default=0, help="Send the first N fixes of each trace via /ping/batch")
+    parser.add_argument("--start-miles", type=float, default=4.0)
+    parser.add_argument("--speed-mph", type=float, default=30.0)
+    parser.add_argument("--interval-s", type=float, default=30.0, help="Simulated seconds between fixes")
+    parser.add_argument("--mode", default="hybrid", choices=["rules", "hybrid", "llm"], help="DECISION_MODE for the agent")
+    parser.add_argument("--workers", type=int, default=8, help="SERVER_WORKERS for the agent")
+    parser.add_argument("--coalesce-window-ms", type=float, default=0,
+                        help="COALESCE_WINDOW_MS (0 so back-to-back synthetic pings aren't throttled)")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-tail-rate", type=float, default=0.0, help="Share of OpenAI calls that stall")
+    parser.add_argument("--llm-tail-ms", type=float, default=5000, help="Latency of a stalled OpenAI call")
+    parser.add_argument("--ifttt-latency-ms", type=float, default=150)
+    parser.add_argument("--langsmith-latency-ms", type=float, default=50)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--ifttt-error-rate", type=float, default=0.0)
+    parser.add_argument("--langsmith-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ingest", default="http", choices=["http", "ha"],
+                        help="POST fixes to /ping, or push them from a fake Home Assistant WebSocket API")
+    parser.add_argument("--ha-drop-every", type=int, default=0,
+                        help="Fake Home Assistant drops the connection after every N events (0 = never)")
+    parser.add_argument("--micro", type=int, metavar="PINGS",
+                        help="Instead of the HTTP load test, time PINGS pings through the in-process ping path")
+    parser.add_argument("--json", dest="json_path", help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    if args.micro:
+        os.environ.update({"OPENAI_API_KEY": "", "IFTTT_KEY": "", "LANGSMITH_API_KEY": "", "DECISION_MODE": "rules",
+                           "COALESCE_WINDOW_MS": "0", "STATE_DB_PATH": "", "LLM_DECISION_LOG": ""})
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import main as agent_main
+        agent_main.logger.setLevel("ERROR")
+        report = micro_benchmark(agent_main, args.micro)
+        if args.json_path:
+            with open(args.json_path, "w") as f:
+                json.dump(report, f, indent=2)
+        return
+
+    services = {
+        "openai": FakeService("openai", args.llm_latency_ms, error_rate=args.openai_error_rate,
+                              tail_rate=args.llm_tail_rate, tail_ms=args.llm_tail_ms),
+        "ifttt": FakeService("ifttt", args.ifttt_latency_ms, error_rate=args.ifttt_error_rate),
+        "langsmith": FakeService("langsmith", args.langsmith_latency_ms, error_rate=args.langsmith_error_rate),
+    }
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), make_fake_handler(services))
+    upstream.daemon_threads = True
+    upstream_url = start_server(upstream)
+
+    # The agent reads its configuration at import time, so point it at the fakes first
+    os.environ.update({
+        "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": f"{upstream_url}/v1",
+        "IFTTT_KEY": "bench", "IFTTT_BASE_URL": upstream_url,
+        "LANGSMITH_API_KEY": "bench", "LANGSMITH_ENDPOINT": upstream_url,
+        "DECISION_MODE": args.mode,
+        "SERVER_WORKERS": str(args.workers),
+        "COALESCE_WINDOW_MS": str(args.coalesce_window_ms),
+        "STATE_DB_PATH": "",
+    })
+    fake_ha = None
+    if args.ingest == "ha":
+        fake_ha = FakeHomeAssistant(drop_every=args.ha_drop_every)
+        os.environ.update({
+            "HA_WEBSOCKET_URL": fake_ha.url, "HA_TOKEN": fake_ha.token, "HA_RECONNECT_MAX_SECONDS": "1",
+            "HA_DEVICE_TRACKERS": ",".join(f"device_tracker.bench_{i}=bench-{i}" for i in range(args.devices)),
+        })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as agent_main
+    agent_main.logger.setLevel("WARNING")
+    agent_main.ACAgentHandler.log_message = lambda self, format, *a: None
+
+    processed = {}  # (lat, lon) -> Event set once process_ping has handled that fix
+    if fake_ha is not None:
+        process_ping = agent_main.process_ping
+
+        def timed_process_ping(payload, endpoint="/ping"):
+            try:
+                return process_ping(payload, endpoint)
+            finally:
+                done = processed.get((payload["lat"], payload["lon"]))
+                if done is not None:
+                    done.set()
+
+        agent_main.process_ping = timed_process_ping
+        agent_main.ha_stream.start()
+
+    server = agent_main.create_server(("127.0.0.1", 0), workers=args.workers)
+    base_url = start_server(server)
+
+    rng = random.Random(args.seed)
+    traces = [commute_trace(agent_main.HOME, args.pings, args.start_miles, args.speed_mph, args.interval_s, rng)
+              for _ in range(args.devices)]
+
+    recorder = LatencyRecorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        if fake_ha is not None:
+            futures = [pool.submit(drive_ha_device, fake_ha, f"device_tracker.bench_{i}", trace, recorder, processed)
+                       for i, trace in enumerate(traces)]
+        else:
+            futures = [pool.submit(drive_device, base_url, f"bench-{i}", trace, args.batch_size, recorder)
+                       for i, trace in enumerate(traces)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    agent_main.actuation_queue.flush()
+    agent_main.tracer.exporter.flush()
+
+    report = {"elapsed_seconds": elapsed, "endpoints": {}, "upstream_calls": {}}
+    print(f"\n📊 Smart AC Agent benchmark: {args.devices} devices x {args.pings} pings, "
+          f"concurrency {args.concurrency}, mode {args.mode}, ingest {args.ingest}")
+    print(f"{'endpoint':<14}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, samples in sorted(recorder.samples.items()):
+        samples.sort()
+        stats = {
+            "requests": len(samples),
+            "errors": recorder.errors.get(endpoint, 0),
+            "throughput_rps": len(samples) / elapsed,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+        }
+        report["endpoints"][endpoint] = stats
+        print(f"{endpoint:<14}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput_rps']:>10.1f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+
+    for name, service in services.items():
+        report["upstream_calls"][name] = {"calls": service.calls, "injected_errors": service.errors}
+    print("Upstream calls: " + ", ".join(f"{name}={service.calls}" for name, service in services.items()))
+    if agent_main.runner.cache is not None:
+        report["decision_cache"] = agent_main.runner.cache.get_stats()
+        print(f"Decision cache hit rate: {report['decision_cache']['hit_rate']:.1%}")
+    tokens = {line.split("}")[0].split('"')[1]: float(line.split()[-1])
+              for line in agent_main.metrics.render().splitlines() if line.startswith("ac_agent_llm_tokens_total{")}
+    if tokens:
+        report["llm_tokens"] = tokens
+        print("LLM tokens: " + ", ".join(f"{kind}={int(count)}" for kind, count in sorted(tokens.items())))
+    if agent_main.runner.learned is not None:
+        report["learned_policy"] = agent_main.runner.learned.get_stats()
+        print(f"Learned policy coverage: {report['learned_policy']['coverage']:.1%}")
+    report["http_clients"] = {name: client.get_stats() for name, client in agent_main.http_clients.items()}
+    openai_stats = report["http_clients"]["openai"]
+    print(f"OpenAI shed: {openai_stats['shed']} (breaker opened {openai_stats['breaker']['opened']}x)")
+    report["llm_hedging"] = hedging = agent_main.llm_caller.get_stats()
+    print(f"LLM hedging: {hedging['hedged']}/{hedging['calls']} calls hedged ({hedging['hedge_rate']:.1%}), "
+          f"{hedging['hedge_wins']} hedge wins, {hedging['deadline_exceeded']} past deadline")
+    if fake_ha is not None:
+        report["home_assistant"] = ha = agent_main.ha_stream.get_stats()
+        print(f"Home Assistant stream: {ha['pings']} pings from {ha['events']} events, "
+              f"{ha['connects']} connects, {ha['disconnects']} disconnects, {ha['errors']} errors")
+        agent_main.ha_stream.close()
+    report["actuation_queue"] = agent_main.actuation_queue.get_stats()
+    print("Actuations: " + ", ".join(f"{key}={report['actuation_queue'][key]}"
+                                      for key in ("delivered", "superseded", "skipped", "failed", "retries")))
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    server.shutdown()
+    server.server_close()
+    upstream.shutdown()
+
+if __name__ == "__main__":
+    main()
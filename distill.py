@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Distill logged LLM decisions into a small on-device decision tree for the Smart AC Agent.
+
+Training data is the JSONL written when LLM_DECISION_LOG is set (or the --llm-cache file used
+by simulate.py): one observation per line plus the LLM's "decision". Training fits a CART tree
+with Gini splits, reports agreement with the LLM on a held-out split, then refits on all data
+and writes a compact JSON model for LEARNED_POLICY_PATH.
+
+    python distill.py train llm_decisions.jsonl --output ac_policy.json --max-depth 6
+    python distill.py report ac_policy.json new_decisions.jsonl --min-confidence 0.9
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("STATE_DB_PATH", "")
+os.environ.setdefault("LANGSMITH_API_KEY", "")
+os.environ.setdefault("LEARNED_POLICY_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main as agent_main
+
+agent_main.logger.setLevel("WARNING")
+
+CLASSES = ["ac_on", "ac_off", "no_action"]
+
+def load_samples(paths):
+    """(Observation, LLM decision) pairs; records that fail validation are skipped."""
+    samples, skipped = [], 0
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    try:
+                        obs = agent_main.Observation.from_dict(record)
+                    except ValueError:
+                        skipped += 1
+                        continue
+                    if record.get("decision") in CLASSES:
+                        samples.append((obs, record["decision"]))
+    if skipped:
+        print(f"⚠️ Skipped {skipped} records that aren't valid observations")
+    return samples
+
+# Training
+def gini(counts, total):
+    return 1.0 - sum((c / total) ** 2 for c in counts) if total else 0.0
+
+def fit_tree(X, y, max_depth=6, min_leaf=5):
+    """CART over numeric features; returns the flat node lists LearnedPolicy expects."""
+    n_classes = len(CLASSES)
+    tree = {"feature": [], "threshold": [], "left": [], "right": [], "label": [], "confidence": []}
+
+    def add_leaf(node, counts):
+        total = sum(counts)
+        best = max(range(n_classes), key=lambda c: counts[c])
+        tree["label"][node] = best
+        # Laplace-smoothed so small leaves report less confidence than large pure ones
+        tree["confidence"][node] = round((counts[best] + 1) / (total + n_classes), 4)
+
+    def build(indices, depth):
+        node = len(tree["feature"])
+        for name, values in tree.items():
+            values.append(0.0 if name in ("threshold", "confidence") else -1)
+        counts = [0] * n_classes
+        for i in indices:
+            counts[y[i]] += 1
+        total = len(indices)
+        parent_impurity = gini(counts, total)
+
+        best = None  # (impurity, feature, threshold, split position, sorted indices)
+        if depth < max_depth and total >= 2 * min_leaf and parent_impurity > 0:
+            for f in range(len(X[0])):
+                ordered = sorted(indices, key=lambda i: X[i][f])
+                left = [0] * n_classes
+                for pos in range(1, total):
+                    left[y[ordered[pos - 1]]] += 1
+                    lo, hi = X[ordered[pos - 1]][f], X[ordered[pos]][f]
+                    if lo == hi or pos < min_leaf or total - pos < min_leaf:
+                        continue
+                    right = [c - l for c, l in zip(counts, left)]
+                    impurity = (pos * gini(left, pos) + (total - pos) * gini(right, total - pos)) / total
+                    if best is None or impurity < best[0]:
+                        best = (impurity, f, (lo + hi) / 2, pos, ordered)
+
+        if best is None or best[0] >= parent_impurity - 1e-12:
+            add_leaf(node, counts)
+            return node
+
+        _, f, threshold, pos, ordered = best
+        tree["feature"][node] = f
+        tree["threshold"][node] = round(threshold, 6)
+        tree["left"][node] = build(ordered[:pos], depth + 1)
+        tree["right"][node] = build(ordered[pos:], depth + 1)
+        return node
+
+    build(list(range(len(X))), 0)
+    return tree
+
+def make_model(samples, max_depth, min_leaf):
+    X = [agent_main.LearnedPolicy.features(obs) for obs, _ in samples]
+    y = [CLASSES.index(decision) for _, decision in samples]
+    return {
+        "format": agent_main.LearnedPolicy.FORMAT,
+        "features": list(agent_main.LearnedPolicy.FEATURES),
+        "classes": CLASSES,
+        **fit_tree(X, y, max_depth, min_leaf),
+        "samples": len(samples),
+    }
+
+# Evaluation
+def evaluate(policy, samples, min_confidence):
+    """Agreement with the logged LLM decisions, overall and for predictions above the threshold."""
+    confusion = {llm: {learned: 0 for learned in CLASSES} for llm in CLASSES}
+    agree = confident = confident_agree = 0
+    start = time.perf_counter()
+    predictions = [policy.predict(obs) for obs, _ in samples]
+    elapsed = time.perf_counter() - start
+    for (_, llm_decision), (decision, confidence) in zip(samples, predictions):
+        confusion[llm_decision][decision] += 1
+        agree += decision == llm_decision
+        if confidence >= min_confidence:
+            confident += 1
+            confident_agree += decision == llm_decision
+    n = len(samples)
+    return {
+        "samples": n,
+        "agreement": agree / n if n else None,
+        "min_confidence": min_confidence,
+        "coverage": confident / n if n else None,  # Share of decisions kept off the LLM
+        "confident_agreement": confident_agree / confident if confident else None,
+        # With low-confidence cases deferred, only confident disagreements change behaviour
+        "effective_agreement": (n - confident + confident_agree) / n if n else None,
+        "inference_us": elapsed / n * 1e6 if n else None,
+        "confusion": confusion,  # LLM decision -> learned decision -> count
+    }
+
+def print_report(title, report):
+    def pct(value):
+        return "n/a" if value is None else f"{value:.1%}"
+
+    print(f"\n🧠 {title}: {report['samples']} decisions")
+    print(f"Agreement with LLM:         {pct(report['agreement'])}")
+    print(f"Coverage at >= {report['min_confidence']:.2f}:       {pct(report['coverage'])}")
+    print(f"Agreement when confident:   {pct(report['confident_agreement'])}")
+    print(f"Effective (defer to LLM):   {pct(report['effective_agreement'])}")
+    if report["inference_us"] is not None:
+        print(f"Inference:                  {report['inference_us']:.2f} µs/decision")
+    header = "LLM / learned"
+    print(f"{header:<14}" + "".join(f"{c:>11}" for c in CLASSES))
+    for llm, row in report["confusion"].items():
+        print(f"{llm:<14}" + "".join(f"{row[c]:>11}" for c in CLASSES))
+
+def train(args):
+    samples = load_samples(args.logs)
+    if len(samples) < 2 * args.min_leaf:
+        sys.exit(f"Need at least {2 * args.min_leaf} logged decisions, found {len(samples)}")
+    shuffled = list(samples)
+    random.Random(args.seed).shuffle(shuffled)
+    n_test = int(len(shuffled) * args.test_fraction)
+    test, train_set = shuffled[:n_test], shuffled[n_test:]
+
+    report = None
+    if test:
+        holdout = agent_main.LearnedPolicy(make_model(train_set, args.max_depth, args.min_leaf))
+        report = evaluate(holdout, test, args.min_confidence)
+        print_report("Held-out agreement", report)
+
+    model = make_model(samples, args.max_depth, args.min_leaf)
+    if report is not None:
+        model["agreement"] = round(report["agreement"], 4)
+        model["coverage"] = round(report["coverage"], 4)
+    with open(args.output, "w") as f:
+        json.dump(model, f, separators=(",", ":"))
+    print(f"\n💾 Wrote {args.output}: {len(model['feature'])} nodes, {os.path.getsize(args.output)} bytes")
+
+    if args.json_path and report is not None:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+def report(args):
+    policy = agent_main.LearnedPolicy.load(args.model)
+    result = evaluate(policy, load_samples(args.logs), args.min_confidence)
+    print_report(f"Agreement of {args.model}", result)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(result, f, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Distill logged LLM decisions into a local decision tree")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = commands.add_parser("train", help="Fit a tree and report held-out agreement")
+    train_parser.add_argument("logs", nargs="+", help="JSONL of observations with the LLM's decision")
+    train_parser.add_argument("--output", "-o", default="ac_policy.json")
+    train_parser.add_argument("--max-depth", type=int, default=6)
+    train_parser.add_argument("--min-leaf", type=int, default=5, help="Minimum samples per leaf")
+    train_parser.add_argument("--test-fraction", type=float, default=0.2)
+    train_parser.add_argument("--seed", type=int, default=1)
+    train_parser.set_defaults(handler=train)
+
+    report_parser = commands.add_parser("report", help="Agreement of a trained model with logged LLM decisions")
+    report_parser.add_argument("model")
+    report_parser.add_argument("logs", nargs="+")
+    report_parser.set_defaults(handler=report)
+
+    for command in (train_parser, report_parser):
+        command.add_argument("--min-confidence", type=float, default=agent_main.LEARNED_POLICY_MIN_CONFIDENCE)
+        command.add_argument("--json", dest="json_path", help="Also write the agreement report as JSON")
+
+    args = parser.parse_args()
+    args.handler(args)
+
+if __name__ == "__main__":
+    main()
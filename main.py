@@ -10,9 +10,41 @@ import time
 import logging
 import json
 import uuid
-from collections import deque
+import random
+import hashlib
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta
+import heapq
+from array import array
+import bisect
+import signal
+import sqlite3
+import cProfile
+import pstats
+import marshal
+import io
+import tracemalloc
+import hmac
+import itertools
+import socket
+import ssl
+import struct
+import base64
+from urllib.parse import urlparse, parse_qs
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; batch distances fall back to pure Python
+    np = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; request/response JSON falls back to the stdlib codec
+    orjson = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -35,33 +67,708 @@ IFTTT_KEY = os.getenv("IFTTT_KEY")
 IFTTT_AC_ON_EVENT = os.getenv("IFTTT_AC_ON_EVENT", "ac_on")
 IFTTT_AC_OFF_EVENT = os.getenv("IFTTT_AC_OFF_EVENT", "ac_off")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+IFTTT_BASE_URL = os.getenv("IFTTT_BASE_URL", "https://maker.ifttt.com")
 
 # LangSmith configuration
 LANGSMITH_API_KEY = os.getenv("LANGSMITH_API_KEY", "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")
 LANGSMITH_PROJECT = os.getenv("LANGSMITH_PROJECT", "ac-bot")
+LANGSMITH_ENDPOINT = os.getenv("LANGSMITH_ENDPOINT", "https://api.smith.langchain.com")
 LANGSMITH_ENABLED = bool(LANGSMITH_API_KEY)
+LANGSMITH_SAMPLE_RATE = float(os.getenv("LANGSMITH_SAMPLE_RATE", "1.0"))  # Fraction of root traces exported
+LANGSMITH_QUEUE_SIZE = int(os.getenv("LANGSMITH_QUEUE_SIZE", "1000"))
+LANGSMITH_BATCH_SIZE = int(os.getenv("LANGSMITH_BATCH_SIZE", "50"))
+LANGSMITH_FLUSH_INTERVAL = float(os.getenv("LANGSMITH_FLUSH_INTERVAL", "2.0"))  # Seconds
+LANGSMITH_DROP_POLICY = os.getenv("LANGSMITH_DROP_POLICY", "drop_oldest")  # drop_oldest, drop_newest or block
 
 HOME = (float(os.getenv("HOME_LAT", "40.7128")), float(os.getenv("HOME_LON", "-74.0060")))
+DEFAULT_HOME_ID = "default"
+DEFAULT_DEVICE_ID = "default"
+
+# Additional homes as JSON: {"cabin": {"lat": 44.1, "lon": -73.9, "ac_on_event": "cabin_ac_on", "ac_off_event": "cabin_ac_off"}}
+# Any home may list geofence "zones" (see ZoneIndex); HOME_ZONES_JSON sets them for the default home
+HOMES = {DEFAULT_HOME_ID: {"lat": HOME[0], "lon": HOME[1], "zones": json.loads(os.getenv("HOME_ZONES_JSON", "[]"))}}
+HOMES.update(json.loads(os.getenv("HOMES_JSON", "{}")))
+ZONE_GRID_DEGREES = float(os.getenv("ZONE_GRID_DEGREES", "0.05"))  # Spatial index cell size (~3.5 mi of latitude)
 
 EARTH_RADIUS_MI = 3958.8
 
 # Location history tracking
 HISTORY_RETENTION_MINUTES = 30  # Keep location history for 30 minutes
+FIX_CLOCK_SKEW_SECONDS = 5  # Fix timestamps this far ahead of our clock are clamped to now; further is rejected
 MIN_SAMPLES_FOR_TREND = 2  # Need at least 2 samples to determine trend
-location_history = deque()
+TREND_SMOOTHING_SECONDS = float(os.getenv("TREND_SMOOTHING_SECONDS", "60"))  # EWMA time constant for radial velocity
+TREND_THRESHOLD_MPH = float(os.getenv("TREND_THRESHOLD_MPH", "1.0"))  # Radial speed that counts as moving
+HISTORY_CAPACITY = int(os.getenv("HISTORY_CAPACITY", "256"))  # Hard cap on fixes held per device
+HISTORY_FULL_RESOLUTION_SECONDS = float(os.getenv("HISTORY_FULL_RESOLUTION_SECONDS", "120"))  # Never downsampled
+HISTORY_BUCKET_SECONDS = float(os.getenv("HISTORY_BUCKET_SECONDS", "10"))  # Narrowest bucket for older fixes
 
-# LangSmith Monitoring Functions
-class LangSmithTracer:
-    def __init__(self):
-        self.api_url = "https://api.smith.langchain.com"
-        self.session_id = str(uuid.uuid4())
+# GPS noise filtering (constant-velocity Kalman filter per device, ahead of history and trend)
+GPS_FILTER_ENABLED = os.getenv("GPS_FILTER_ENABLED", "true").lower() == "true"
+GPS_DEFAULT_ACCURACY_M = float(os.getenv("GPS_DEFAULT_ACCURACY_M", "20"))  # Assumed when a fix has no accuracy_m
+GPS_MAX_ACCURACY_M = float(os.getenv("GPS_MAX_ACCURACY_M", "500"))  # Fixes reported less accurate than this are dropped
+GPS_ACCEL_NOISE = float(os.getenv("GPS_ACCEL_NOISE", "1.0"))  # m/s^2 of unmodelled acceleration (process noise)
+GPS_OUTLIER_SIGMA = float(os.getenv("GPS_OUTLIER_SIGMA", "4"))  # Reject fixes this many std devs from the prediction
+GPS_OUTLIER_RESET = int(os.getenv("GPS_OUTLIER_RESET", "3"))  # Consecutive rejections before restarting at the fix
+
+# Per-device state store (sharded, lock-striped, idle devices evicted)
+STATE_SHARDS = int(os.getenv("STATE_SHARDS", "16"))
+MAX_DEVICES = int(os.getenv("MAX_DEVICES", "10000"))
+DEVICE_IDLE_TTL_MINUTES = float(os.getenv("DEVICE_IDLE_TTL_MINUTES", "120"))
+
+# Durable state: SQLite (WAL) journal of pings and decisions, replayed on startup ("" disables)
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "ac_agent_state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))  # Seconds between batched commits
+
+# Decision path: "rules" (local engine only), "hybrid" (rules, LLM for edge cases) or "llm" (every ping)
+DECISION_MODE = os.getenv("DECISION_MODE", "hybrid")
+RULES_BOUNDARY_MARGIN_MI = float(os.getenv("RULES_BOUNDARY_MARGIN_MI", "0.05"))  # Escalate within this of a band edge
+RULES_ESCALATE_ON = [c.strip() for c in os.getenv("RULES_ESCALATE_ON", "boundary,trend_change,conflict").split(",") if c.strip()]
+
+# Distilled local policy (see distill.py), consulted before the LLM in hybrid mode
+LEARNED_POLICY_PATH = os.getenv("LEARNED_POLICY_PATH", "")
+LEARNED_POLICY_MIN_CONFIDENCE = float(os.getenv("LEARNED_POLICY_MIN_CONFIDENCE", "0.9"))  # Below this, ask the LLM
+LLM_DECISION_LOG = os.getenv("LLM_DECISION_LOG", "")  # JSONL of (observation, LLM decision) pairs for training
+LLM_DECISION_LOG_MAX_MB = float(os.getenv("LLM_DECISION_LOG_MAX_MB", "20"))  # Rotated to <path>.1 past this size
+
+# LLM request shape
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "true").lower() == "true"  # JSON schema enum response
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "16"))  # {"action": "no_action"} is ~7 tokens
+
+# LLM deadline and request hedging
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "8"))  # Per decision; then the local rules decide (0 = none)
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))  # Hedge calls slower than this latency percentile (0 = off)
+LLM_HEDGE_MAX_RATE = float(os.getenv("LLM_HEDGE_MAX_RATE", "0.1"))  # At most this share of calls get a hedge
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))  # Recent call latencies the percentile is taken over
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "")  # Model for hedged requests (empty = same model)
+
+# LLM decision cache (keyed on a quantized observation)
+DECISION_CACHE_ENABLED = os.getenv("DECISION_CACHE_ENABLED", "true").lower() == "true"
+DECISION_CACHE_MAX_ENTRIES = int(os.getenv("DECISION_CACHE_MAX_ENTRIES", "1024"))
+DECISION_CACHE_TTL_SECONDS = float(os.getenv("DECISION_CACHE_TTL_SECONDS", "600"))
+DECISION_CACHE_DISTANCE_BUCKET_MI = float(os.getenv("DECISION_CACHE_DISTANCE_BUCKET_MI", "0.05"))
+DECISION_CACHE_SPEED_BUCKET_MPH = float(os.getenv("DECISION_CACHE_SPEED_BUCKET_MPH", "10"))
+
+# Outbound HTTP clients: per-service timeout (seconds) and retry budget
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))  # Keep-alive connections per host
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.25"))  # Base for jittered exponential backoff
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", "2"))
+IFTTT_TIMEOUT = float(os.getenv("IFTTT_TIMEOUT", "10"))
+IFTTT_RETRIES = int(os.getenv("IFTTT_RETRIES", "2"))
+LANGSMITH_TIMEOUT = float(os.getenv("LANGSMITH_TIMEOUT", "5"))
+LANGSMITH_RETRIES = int(os.getenv("LANGSMITH_RETRIES", "1"))
+
+# HTTP server concurrency (1 = serve requests one at a time)
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "8"))
+SERVER_QUEUE_SIZE = int(os.getenv("SERVER_QUEUE_SIZE", str(SERVER_WORKERS * 4)))  # Waiting connections; beyond, 503
+SERVER_REQUEST_TIMEOUT = float(os.getenv("SERVER_REQUEST_TIMEOUT", "30"))  # Socket timeout for reading and writing a request
+
+# Circuit breakers (per service) and LLM admission control
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))  # Recent calls considered
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))  # Calls needed in the window before it can trip
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))  # Share of failed or slow calls that opens it
+BREAKER_SLOW_SECONDS = float(os.getenv("BREAKER_SLOW_SECONDS", "10"))  # Calls slower than this count as failures
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))  # Time open before a half-open probe
+# Concurrent OpenAI calls; beyond this, shed to rules. Defaults to one per request worker, so it only
+# sheds when other ingest paths (Home Assistant, coalesced trailing pings) add calls on top
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", str(SERVER_WORKERS)))
+
+# Ping coalescing: bursts for one device within this window share one trailing evaluation (0 disables)
+COALESCE_WINDOW_MS = float(os.getenv("COALESCE_WINDOW_MS", "500"))
+COALESCE_ACK = os.getenv("COALESCE_ACK", "false").lower() == "true"  # Answer coalesced pings with 202 instead of waiting
+
+
+# Home Assistant WebSocket ingest: one persistent subscription instead of a rest_command POST per move
+HA_WEBSOCKET_URL = os.getenv("HA_WEBSOCKET_URL", "")  # e.g. ws://homeassistant:8123/api/websocket (empty disables)
+HA_TOKEN = os.getenv("HA_TOKEN", "")  # Long-lived access token
+HA_DEVICE_TRACKERS = os.getenv("HA_DEVICE_TRACKERS", "")  # entity_id[=device_id], comma separated
+HA_HOME_ID = os.getenv("HA_HOME_ID", DEFAULT_HOME_ID)
+HA_PING_INTERVAL = float(os.getenv("HA_PING_INTERVAL", "30"))  # Seconds of silence before a heartbeat ping
+HA_RECONNECT_MAX_SECONDS = float(os.getenv("HA_RECONNECT_MAX_SECONDS", "60"))  # Backoff cap between reconnects
+
+# AC actuation: commands are queued per device and delivered to IFTTT by background workers
+ACTUATION_ASYNC = os.getenv("ACTUATION_ASYNC", "true").lower() == "true"  # false = /ping waits for delivery
+ACTUATION_WORKERS = int(os.getenv("ACTUATION_WORKERS", "2"))
+ACTUATION_MAX_ATTEMPTS = int(os.getenv("ACTUATION_MAX_ATTEMPTS", "3"))  # Delivery attempts before giving up
+ACTUATION_RETRY_BACKOFF = float(os.getenv("ACTUATION_RETRY_BACKOFF", "1.0"))  # Seconds, doubled per attempt
+ACTUATION_WAIT_SECONDS = float(os.getenv("ACTUATION_WAIT_SECONDS", "30"))  # Wait for delivery when not async
+
+# On-demand profiling (/debug/*); the endpoints don't exist unless a token is configured
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+
+# Live event stream (/events server-sent events)
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "32"))
+EVENTS_BUFFER = int(os.getenv("EVENTS_BUFFER", "256"))  # Events held per subscriber; a slow one loses the oldest
+EVENTS_KEEPALIVE_SECONDS = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", "15"))  # Idle comment interval and write timeout
+
+# Local metrics (Prometheus text format on /metrics)
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRIC_HELP = {
+    "ac_agent_stage_seconds": ("histogram", "Latency of each request-processing stage"),
+    "ac_agent_request_seconds": ("histogram", "End-to-end request latency by endpoint"),
+    "ac_agent_decisions_total": ("counter", "Decisions by resulting action and deciding path"),
+    "ac_agent_errors_total": ("counter", "Errors by external service"),
+    "ac_agent_llm_tokens_total": ("counter", "OpenAI tokens used"),
+    "ac_agent_actuations_total": ("counter", "AC commands by delivery outcome"),
+    "ac_agent_actuation_delivery_seconds": ("histogram", "Time from queueing an AC command to confirmed delivery"),
+    "ac_agent_actuation_queue_depth": ("gauge", "AC commands waiting for or in delivery"),
+    "ac_agent_circuit_state": ("gauge", "Circuit breaker state per service (0 closed, 1 half-open, 2 open)"),
+    "ac_agent_shed_total": ("counter", "Calls refused locally by circuit breakers or in-flight limits, and connections refused by a full server queue"),
+    "ac_agent_gps_fixes_total": ("counter", "Location fixes accepted or rejected by the GPS noise filter"),
+    "ac_agent_events_total": ("counter", "Events published to /events subscribers by type"),
+    "ac_agent_history_downsampled_total": ("counter", "Older history fixes merged away to keep devices within capacity"),
+}
+
+class Metrics:
+    """Counters and latency histograms recorded into per-thread shards.
+    
+    Each thread only ever writes its own shard, so recording takes no lock; /metrics sums the
+    shards when scraped.
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.local = threading.local()
+        self.shards = []
+        self.gauges = {}  # (name, labels) -> callable sampled at scrape time
+        self.lock = threading.Lock()  # Only taken when a thread records its first sample
+    
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = ({}, {})
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+    
+    def inc(self, name, value=1, **labels):
+        counters = self._shard()[0]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+    
+    def observe(self, name, seconds, **labels):
+        histograms = self._shard()[1]
+        key = (name, tuple(sorted(labels.items())))
+        histogram = histograms.get(key)
+        if histogram is None:
+            # Per-bucket counts (last slot is +Inf), then the running sum
+            histogram = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+    
+    def timer(self, name, **labels):
+        return StageTimer(self, name, labels)
+    
+    def gauge(self, name, read, **labels):
+        """Register a callable whose current value is reported on each scrape."""
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = read
+    
+    def render(self):
+        """Merge all shards into Prometheus text exposition format."""
+        counters, histograms = {}, {}
+        with self.lock:
+            shards = list(self.shards)
+            gauges = dict(self.gauges)
+        for shard_counters, shard_histograms in shards:
+            for key, value in dict(shard_counters).items():
+                counters[key] = counters.get(key, 0) + value
+            for key, histogram in dict(shard_histograms).items():
+                merged = histograms.setdefault(key, [0] * len(histogram))
+                for i, value in enumerate(list(histogram)):
+                    merged[i] += value
         
-    def create_run(self, name, inputs, run_type="chain", parent_run_id=None):
-        """Create a new LangSmith run/trace"""
-        if not LANGSMITH_ENABLED:
-            return str(uuid.uuid4())  # Return dummy ID if disabled
+        lines, described = [], set()
+        
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+        
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+        
+        for (name, labels), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        
+        for (name, labels), read in sorted(gauges.items(), key=lambda item: item[0]):
+            describe(name)
+            lines.append(f"{name}{format_labels(labels)} {read()}")
+        
+        for (name, labels), histogram in sorted(histograms.items()):
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], histogram[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        
+        return "\n".join(lines) + "\n"
+
+class StageTimer:
+    """Context manager that records elapsed time into a histogram."""
+    
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+metrics = Metrics()
+
+# Pooled HTTP clients for external services
+class ServiceUnavailable(Exception):
+    """A call was refused or given up locally: the service's circuit is open, its in-flight limit is
+    reached, or it missed its deadline."""
+    
+    def __init__(self, service, reason):
+        super().__init__(f"{service} unavailable ({reason})")
+        self.service = service
+        self.reason = reason  # "circuit_open", "saturated" or "deadline"
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over the failure-or-slow rate of recent calls.
+    
+    Closed: calls pass and outcomes fill a rolling window; once BREAKER_MIN_CALLS are in it and
+    the failed-or-slow share reaches BREAKER_FAILURE_RATE, it opens. Open: calls are refused for
+    BREAKER_OPEN_SECONDS. Half-open: one probe call is let through; success closes, failure reopens.
+    """
+    
+    STATES = ("closed", "half_open", "open")
+    
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, failure_rate=BREAKER_FAILURE_RATE,
+                 slow_seconds=BREAKER_SLOW_SECONDS, open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.outcomes = deque(maxlen=window)  # True = failed or slow
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "rejected": 0}
+    
+    def allow(self):
+        """Whether a call may go ahead; in half-open state only a single probe is admitted."""
+        with self.lock:
+            if self.state == "open" and time.time() - self.opened_at >= self.open_seconds:
+                self.state, self.probing = "half_open", False
+                events.publish("breaker", service=self.name, state=self.state)
+            if self.state == "closed" or (self.state == "half_open" and not self.probing):
+                self.probing = self.state == "half_open"
+                return True
+            self.stats["rejected"] += 1
+            return False
+    
+    def record(self, ok, seconds=0.0):
+        failed = not ok or seconds > self.slow_seconds
+        with self.lock:
+            if self.state == "half_open":
+                self.probing = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                    logger.info(f"🔌 {self.name} circuit closed")
+                    events.publish("breaker", service=self.name, state=self.state)
+                return
+            self.outcomes.append(failed)
+            if (self.state == "closed" and len(self.outcomes) >= self.min_calls
+                    and sum(self.outcomes) / len(self.outcomes) >= self.failure_rate):
+                self._open()
+    
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.time()
+        self.stats["opened"] += 1
+        logger.warning(f"🔌 {self.name} circuit opened for {self.open_seconds:g}s")
+        events.publish("breaker", service=self.name, state=self.state, open_seconds=self.open_seconds)
+    
+    def get_stats(self):
+        with self.lock:
+            failures = sum(self.outcomes)
+            return {**self.stats, "state": self.state, "window_calls": len(self.outcomes),
+                    "failure_rate": failures / len(self.outcomes) if self.outcomes else 0.0}
+
+class ServiceClient:
+    """Keep-alive session for one external service with a timeout, bounded jittered retries,
+    a circuit breaker and an optional cap on concurrent calls."""
+    
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    
+    def __init__(self, name, timeout, retries, backoff=HTTP_RETRY_BACKOFF, pool_size=HTTP_POOL_SIZE,
+                 max_in_flight=None):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.breaker = CircuitBreaker(name)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "errors": 0, "shed": 0}
+        metrics.gauge("ac_agent_circuit_state", lambda: CircuitBreaker.STATES.index(self.breaker.state),
+                      service=name.lower())
+    
+    def request(self, method, url, deadline=None, cancel=None, **kwargs):
+        """Send with retries; raises ServiceUnavailable instead of waiting when the service is unhealthy.
+        
+        deadline (time.monotonic()) caps each attempt's timeout and stops retries that wouldn't start
+        before it; setting the cancel Event stops further retries. Either way the in-flight slot is
+        released once the current attempt ends, instead of after every retry has run.
+        """
+        with self.lock:
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+                self.stats["shed"] += 1
+                metrics.inc("ac_agent_shed_total", service=self.name.lower(), reason="saturated")
+                raise ServiceUnavailable(self.name, "saturated")
+            self.in_flight += 1
+        try:
+            return self._request(method, url, deadline, cancel, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+    
+    def _request(self, method, url, deadline=None, cancel=None, **kwargs):
+        timeout = kwargs.pop("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                with self.lock:
+                    self.stats["shed"] += 1
+                metrics.inc("ac_agent_shed_total", service=self.name.lower(), reason="circuit_open")
+                raise ServiceUnavailable(self.name, "circuit_open")
+            with self.lock:
+                self.stats["requests"] += 1
+            if deadline is not None:
+                kwargs["timeout"] = max(0.001, min(timeout, deadline - time.monotonic()))
+            else:
+                kwargs["timeout"] = timeout
+            # Full jitter keeps retries from synchronising across workers
+            delay = random.uniform(0, self.backoff * (2 ** attempt))
+            start_time = time.time()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.record(False, time.time() - start_time)
+                if self._give_up(attempt, delay, deadline, cancel):
+                    with self.lock:
+                        self.stats["errors"] += 1
+                    raise
+                logger.warning(f"⚠️ {self.name} request failed ({e}), retrying")
+            except Exception:
+                self.breaker.record(False, time.time() - start_time)
+                raise
+            else:
+                ok = response.status_code not in self.RETRY_STATUSES
+                self.breaker.record(ok, time.time() - start_time)
+                if ok or self._give_up(attempt, delay, deadline, cancel):
+                    return response
+                logger.warning(f"⚠️ {self.name} returned {response.status_code}, retrying")
+            with self.lock:
+                self.stats["retries"] += 1
+            time.sleep(delay)
+    
+    def _give_up(self, attempt, delay, deadline, cancel):
+        """True when no retry should follow this attempt."""
+        if attempt == self.retries or (cancel is not None and cancel.is_set()):
+            return True
+        return deadline is not None and time.monotonic() + delay >= deadline
+    
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+    
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+    
+    def get_stats(self):
+        """Request counters plus connection reuse from the underlying urllib3 pools."""
+        pools = self.adapter.poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        pooled_requests = sum(pools[key].num_requests for key in pools.keys())
+        with self.lock:
+            stats = {
+                **self.stats,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "connections_opened": connections,
+                "connections_reused": max(pooled_requests - connections, 0),
+                "timeout_seconds": self.timeout
+            }
+        stats["breaker"] = self.breaker.get_stats()
+        return stats
+
+http_clients = {
+    "openai": ServiceClient("OpenAI", OPENAI_TIMEOUT, OPENAI_RETRIES, max_in_flight=LLM_MAX_IN_FLIGHT or None),
+    "ifttt": ServiceClient("IFTTT", IFTTT_TIMEOUT, IFTTT_RETRIES),
+    "langsmith": ServiceClient("LangSmith", LANGSMITH_TIMEOUT, LANGSMITH_RETRIES),
+}
+
+def breaker_states():
+    return {name: client.breaker.state for name, client in http_clients.items()}
+
+class HedgedCaller:
+    """Deadline-bound calls to one service, hedged with a duplicate request when the first is slow.
+    
+    Once LLM_HEDGE_PERCENTILE of recent calls would have finished, a second request is sent (to
+    LLM_FALLBACK_MODEL if set) and whichever answers first wins. The loser can't be interrupted
+    mid-request, so it is abandoned: its result is discarded, its tokens are counted as
+    "abandoned", and it makes no further retries. Every attempt's timeout is capped at the
+    deadline, so no call holds its in-flight slot past it. Hedges are limited to
+    LLM_HEDGE_MAX_RATE of calls so the extra token cost stays bounded.
+    """
+    
+    MIN_SAMPLES = 20  # Latencies needed before the percentile is trusted
+    
+    def __init__(self, client, deadline=LLM_DEADLINE_SECONDS, percentile=LLM_HEDGE_PERCENTILE,
+                 max_rate=LLM_HEDGE_MAX_RATE, window=LLM_HEDGE_WINDOW, fallback_model=LLM_FALLBACK_MODEL):
+        self.client = client
+        self.deadline = deadline
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.fallback_model = fallback_model or None
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        # Larger than the client's in-flight cap, so calls over it are shed by the client rather than queued here
+        self.pool = ThreadPoolExecutor(max_workers=2 * (client.max_in_flight or 16), thread_name_prefix="llm-call")
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "hedges_capped": 0, "deadline_exceeded": 0,
+                      "abandoned": 0}
+    
+    @property
+    def enabled(self):
+        return self.deadline > 0 or self.percentile > 0
+    
+    def hedge_delay(self):
+        """Seconds after which to hedge, or None until enough latencies have been seen."""
+        with self.lock:
+            if self.percentile <= 0 or len(self.latencies) < self.MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+    
+    def post(self, url, json, **kwargs):
+        """POST, hedging if slow; returns (response, role, model) where role is "primary" or "hedge".
+        
+        Raises ServiceUnavailable(reason="deadline") if neither request answers within the deadline.
+        """
+        if not self.enabled:
+            return self.client.post(url, json=json, **kwargs), "primary", json.get("model")
+        
+        start = time.monotonic()
+        deadline_at = start + self.deadline if self.deadline > 0 else None
+        with self.lock:
+            self.stats["calls"] += 1
+        
+        pending = {self._submit(url, json, deadline_at, kwargs): ("primary", json.get("model"))}
+        delay = self.hedge_delay()
+        hedge_at = start + delay if delay is not None else None
+        outcome = None  # Latest failure (exception or error response), used if nothing succeeds
+        while pending:
+            wake = [t for t in (hedge_at, deadline_at) if t is not None]
+            timeout = max(0.0, min(wake) - time.monotonic()) if wake else None
+            for future in wait(pending, timeout=timeout, return_when=FIRST_COMPLETED).done:
+                role, model = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    outcome = e
+                    continue
+                if response.status_code == 200:
+                    self._abandon(pending)
+                    if role == "hedge":
+                        with self.lock:
+                            self.stats["hedge_wins"] += 1
+                    return response, role, model
+                outcome = (response, role, model)
+            if not pending:
+                break
             
-        run_id = str(uuid.uuid4())
+            now = time.monotonic()
+            if deadline_at is not None and now >= deadline_at:
+                self._abandon(pending)
+                with self.lock:
+                    self.stats["deadline_exceeded"] += 1
+                raise ServiceUnavailable(self.client.name, "deadline")
+            if hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                with self.lock:
+                    capped = self.stats["hedged"] >= self.max_rate * self.stats["calls"]
+                    self.stats["hedges_capped" if capped else "hedged"] += 1
+                if not capped:
+                    model = self.fallback_model or json.get("model")
+                    pending[self._submit(url, {**json, "model": model}, deadline_at, kwargs)] = ("hedge", model)
+        
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    
+    def _submit(self, url, body, deadline, kwargs):
+        started = time.monotonic()
+        cancel = threading.Event()
+        future = self.pool.submit(self.client.post, url, json=body, deadline=deadline, cancel=cancel, **kwargs)
+        future.cancel_retries = cancel.set  # Called when the request is abandoned
+        future.add_done_callback(lambda f: self._record_latency(f, time.monotonic() - started))
+        return future
+    
+    def _record_latency(self, future, seconds):
+        # Abandoned requests still report in, so the percentile isn't biased toward the winners;
+        # timeouts count at their full length, other failures say nothing about latency
+        try:
+            future.result()
+        except requests.Timeout:
+            pass
+        except Exception:
+            return
+        with self.lock:
+            self.latencies.append(seconds)
+    
+    def _abandon(self, pending):
+        with self.lock:
+            self.stats["abandoned"] += len(pending)
+        for future in pending:
+            future.cancel_retries()
+            future.add_done_callback(self._count_abandoned_tokens)
+    
+    @staticmethod
+    def _count_abandoned_tokens(future):
+        try:
+            response = future.result()
+            if response.status_code == 200:
+                metrics.inc("ac_agent_llm_tokens_total", response.json().get("usage", {}).get("total_tokens", 0),
+                            kind="abandoned")
+        except Exception:
+            pass
+    
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+    
+    def get_stats(self):
+        with self.lock:
+            calls, hedged = self.stats["calls"], self.stats["hedged"]
+            stats = {**self.stats, "samples": len(self.latencies)}
+        stats["hedge_rate"] = hedged / calls if calls else 0.0
+        stats["hedge_win_rate"] = stats["hedge_wins"] / hedged if hedged else 0.0
+        stats["hedge_after_seconds"] = self.hedge_delay()
+        stats["deadline_seconds"] = self.deadline or None
+        stats["fallback_model"] = self.fallback_model
+        return stats
+
+llm_caller = HedgedCaller(http_clients["openai"])
+
+# LangSmith Monitoring Functions
+class TraceExporter:
+    """Bounded queue of LangSmith run events sent in batches by a background thread."""
+    
+    def __init__(self, api_url, max_queue=LANGSMITH_QUEUE_SIZE, batch_size=LANGSMITH_BATCH_SIZE,
+                 flush_interval=LANGSMITH_FLUSH_INTERVAL, drop_policy=LANGSMITH_DROP_POLICY):
+        self.api_url = api_url
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.flush_requested = False
+        self.closed = False
+        self.thread = None
+        self.stats = {"enqueued": 0, "dropped": 0, "sent": 0, "failed": 0, "batches": 0}
+    
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="langsmith-exporter", daemon=True)
+                self.thread.start()
+    
+    def submit(self, kind, data):
+        """Queue a "post" (create) or "patch" (update) event without blocking on the network."""
+        self.start()
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                if self.drop_policy == "drop_oldest":
+                    self.queue.popleft()
+                    self.stats["dropped"] += 1
+                elif self.drop_policy == "block":
+                    # Apply brief backpressure, then drop if the flusher still can't keep up
+                    self.cond.wait_for(lambda: len(self.queue) < self.max_queue, timeout=self.flush_interval)
+                    if len(self.queue) >= self.max_queue:
+                        self.stats["dropped"] += 1
+                        return False
+                else:
+                    self.stats["dropped"] += 1
+                    return False
+            self.queue.append((kind, data))
+            self.stats["enqueued"] += 1
+            if len(self.queue) >= self.batch_size:
+                self.cond.notify_all()
+        return True
+    
+    def flush(self, timeout=10):
+        """Wait until everything queued so far has been sent (or the timeout expires)."""
+        with self.cond:
+            self.flush_requested = True
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.queue and not self.in_flight, timeout=timeout)
+    
+    def close(self, timeout=10):
+        self.flush(timeout)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or self.flush_requested or len(self.queue) >= self.batch_size,
+                                   timeout=self.flush_interval)
+                if self.closed and not self.queue:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                if not self.queue:
+                    self.flush_requested = False
+                self.in_flight = len(batch)
+                self.cond.notify_all()
+            
+            if batch:
+                self._send(batch)
+            
+            with self.cond:
+                self.in_flight = 0
+                self.cond.notify_all()
+    
+    def _send(self, batch):
+        with metrics.timer("ac_agent_stage_seconds", stage="trace_export"):
+            self._send_batch(batch)
+    
+    def _send_batch(self, batch):
+        # Fold updates into creates from the same batch so each run is sent once
+        posts, patches = {}, []
+        for kind, data in batch:
+            if kind == "post":
+                posts[data["id"]] = data
+            elif data["id"] in posts:
+                posts[data["id"]].update(data)
+            else:
+                patches.append(data)
         
         try:
             headers = {
@@ -69,31 +776,85 @@ class LangSmithTracer:
                 "Content-Type": "application/json"
             }
             
-            data = {
-                "id": run_id,
-                "name": name,
-                "run_type": run_type,
-                "inputs": inputs,
-                "session_name": f"coral-agent-{datetime.now().strftime('%Y-%m-%d')}",
-                "project_name": LANGSMITH_PROJECT,
-                "start_time": datetime.utcnow().isoformat() + "Z",
-                "parent_run_id": parent_run_id
-            }
-            
-            response = requests.post(
-                f"{self.api_url}/runs",
+            response = http_clients["langsmith"].post(
+                f"{self.api_url}/runs/batch",
                 headers=headers,
-                json=data,
-                timeout=5
+                json={"post": list(posts.values()), "patch": patches}
             )
             
-            if response.status_code in [200, 201]:
-                logger.info(f"📊 LangSmith trace created: {name}")
+            if response.status_code in [200, 201, 202]:
+                self.stats["sent"] += len(batch)
+                self.stats["batches"] += 1
+                logger.debug(f"📊 LangSmith batch exported: {len(posts)} created, {len(patches)} updated")
             else:
-                logger.warning(f"⚠️ LangSmith trace failed: {response.status_code}")
+                self.stats["failed"] += len(batch)
+                metrics.inc("ac_agent_errors_total", service="langsmith")
+                logger.warning(f"⚠️ LangSmith batch failed: {response.status_code}")
                 
         except Exception as e:
-            logger.warning(f"⚠️ LangSmith trace error: {e}")
+            self.stats["failed"] += len(batch)
+            metrics.inc("ac_agent_errors_total", service="langsmith")
+            logger.warning(f"⚠️ LangSmith batch error: {e}")
+    
+    def get_stats(self):
+        with self.cond:
+            return {**self.stats, "queued": len(self.queue)}
+
+class LangSmithTracer:
+    def __init__(self, sample_rate=LANGSMITH_SAMPLE_RATE):
+        self.api_url = LANGSMITH_ENDPOINT
+        self.session_id = str(uuid.uuid4())
+        self.sample_rate = sample_rate
+        self.exporter = TraceExporter(self.api_url)
+        self.unsampled_runs = {}  # Runs dropped by head sampling -> their root run
+        self.unsampled_children = {}  # Unsampled root run -> descendants, forgotten when the root closes
+        self.sampling_lock = threading.Lock()
+    
+    def _is_sampled(self, run_id, parent_run_id, sampled=None):
+        """Head sampling: decide at the root run, children inherit the decision.
+        
+        An unsampled child is remembered until its root closes, so runs started under it after it
+        has closed (but while the root is open) still inherit. Work that outlives the root, like
+        queued actuations, captures is_sampled() up front and passes it in as `sampled`.
+        """
+        with self.sampling_lock:
+            if sampled is None:
+                if parent_run_id is None:
+                    sampled = random.random() < self.sample_rate
+                else:
+                    sampled = parent_run_id not in self.unsampled_runs
+            if not sampled:
+                root = self.unsampled_runs.get(parent_run_id, run_id)
+                self.unsampled_runs[run_id] = root
+                if root != run_id:
+                    self.unsampled_children.setdefault(root, []).append(run_id)
+            return sampled
+    
+    def is_sampled(self, run_id):
+        return run_id not in self.unsampled_runs
+        
+    def create_run(self, name, inputs, run_type="chain", parent_run_id=None, sampled=None):
+        """Create a new LangSmith run/trace"""
+        if not LANGSMITH_ENABLED:
+            return str(uuid.uuid4())  # Return dummy ID if disabled
+            
+        run_id = str(uuid.uuid4())
+        if not self._is_sampled(run_id, parent_run_id, sampled):
+            return run_id
+        
+        data = {
+            "id": run_id,
+            "name": name,
+            "run_type": run_type,
+            "inputs": inputs,
+            "session_name": f"coral-agent-{datetime.now().strftime('%Y-%m-%d')}",
+            "project_name": LANGSMITH_PROJECT,
+            "start_time": datetime.utcnow().isoformat() + "Z",
+            "parent_run_id": parent_run_id
+        }
+        
+        if not self.exporter.submit("post", data):
+            logger.warning(f"⚠️ LangSmith trace dropped (queue full): {name}")
             
         return run_id
     
@@ -101,38 +862,30 @@ class LangSmithTracer:
         """Update a LangSmith run with outputs/error"""
         if not LANGSMITH_ENABLED:
             return
-            
-        try:
-            headers = {
-                "x-api-key": LANGSMITH_API_KEY,
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "end_time": datetime.utcnow().isoformat() + "Z"
-            }
-            
-            if outputs:
-                data["outputs"] = outputs
-            if error:
-                data["error"] = str(error)
-            if metadata:
-                data["extra"] = metadata
-                
-            response = requests.patch(
-                f"{self.api_url}/runs/{run_id}",
-                headers=headers,
-                json=data,
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                logger.info(f"📊 LangSmith trace updated: {run_id}")
-            else:
-                logger.warning(f"⚠️ LangSmith update failed: {response.status_code}")
-                
-        except Exception as e:
-            logger.warning(f"⚠️ LangSmith update error: {e}")
+        
+        with self.sampling_lock:
+            root = self.unsampled_runs.get(run_id)
+            if root is not None:
+                if root == run_id:
+                    del self.unsampled_runs[run_id]
+                    for child in self.unsampled_children.pop(run_id, ()):
+                        self.unsampled_runs.pop(child, None)
+                return
+        
+        data = {
+            "id": run_id,
+            "end_time": datetime.utcnow().isoformat() + "Z"
+        }
+        
+        if outputs:
+            data["outputs"] = outputs
+        if error:
+            data["error"] = str(error)
+        if metadata:
+            data["extra"] = metadata
+        
+        if not self.exporter.submit("patch", data):
+            logger.warning(f"⚠️ LangSmith update dropped (queue full): {run_id}")
 
 # Initialize tracer
 tracer = LangSmithTracer()
@@ -144,41 +897,865 @@ def haversine(a, b):
     h = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
     return EARTH_RADIUS_MI * 2 * math.asin(math.sqrt(h))
 
-def cleanup_old_locations():
-    """Remove location history older than HISTORY_RETENTION_MINUTES."""
-    cutoff_time = time.time() - (HISTORY_RETENTION_MINUTES * 60)
-    while location_history and location_history[0]["timestamp"] < cutoff_time:
-        location_history.popleft()
+def haversine_many(lats, lons, home):
+    """Vectorized haversine: distances in miles from each (lat, lon) to home."""
+    if np is None:
+        return [haversine((lat, lon), home) for lat, lon in zip(lats, lons)]
+    lat1, lon1 = math.radians(home[0]), math.radians(home[1])
+    lat2, lon2 = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return (EARTH_RADIUS_MI * 2 * np.arcsin(np.sqrt(h))).tolist()
 
-def determine_movement_trend():
-    """Determine if user is moving toward or away from home based on recent history."""
-    if len(location_history) < MIN_SAMPLES_FOR_TREND:
-        return "unknown"
+# Geofence zones
+MILES_PER_DEGREE = EARTH_RADIUS_MI * math.pi / 180
+ZONE_ACTIONS = ("ac_on", "ac_off", "no_action")
+
+class Zone:
+    """A ring (inner/outer radius around a centre) or polygon belonging to one home."""
     
-    # Look at the last few samples to determine trend
-    recent_samples = list(location_history)[-MIN_SAMPLES_FOR_TREND:]
+    __slots__ = ("home_id", "name", "kind", "action", "when", "lat", "lon", "cos_lat", "inner", "outer",
+                 "sure_inside", "maybe_inside", "points", "bbox")
     
-    # Calculate average distance change
-    distance_changes = []
-    for i in range(1, len(recent_samples)):
-        prev_dist = recent_samples[i-1]["distance"]
-        curr_dist = recent_samples[i]["distance"]
-        distance_changes.append(curr_dist - prev_dist)
+    # Equirectangular distance is within a fraction of a percent of haversine at geofence scales;
+    # fixes inside this relative margin of a ring edge are settled with the exact haversine
+    EDGE_MARGIN = 0.01
     
-    if not distance_changes:
-        return "unknown"
+    def __init__(self, home_id, home, spec, index=0):
+        self.home_id = home_id
+        self.name = str(spec.get("name") or f"zone{index}")
+        self.kind = spec.get("type", "ring")
+        self.action = spec.get("action")
+        self.when = spec.get("when")  # Movement trend(s) required for the action, e.g. "approaching"
+        if isinstance(self.when, str):
+            self.when = (self.when,)
+        elif self.when is not None:
+            self.when = tuple(self.when)
+        if self.action is not None and self.action not in ZONE_ACTIONS:
+            raise ValueError(f"Zone {home_id}/{self.name}: action must be one of {ZONE_ACTIONS}")
+        
+        if self.kind == "ring":
+            self.lat = float(spec.get("lat", home["lat"]))
+            self.lon = float(spec.get("lon", home["lon"]))
+            self.inner = float(spec.get("inner_mi", 0))
+            self.outer = float(spec["outer_mi"])
+            if not 0 <= self.inner < self.outer:
+                raise ValueError(f"Zone {home_id}/{self.name}: need 0 <= inner_mi < outer_mi")
+            self.cos_lat = math.cos(math.radians(self.lat))
+            m = self.EDGE_MARGIN
+            # Squared equirectangular bounds: certainly inside, and possibly inside (needs haversine)
+            self.sure_inside = ((self.inner * (1 + m)) ** 2, (self.outer * (1 - m)) ** 2)
+            self.maybe_inside = ((self.inner * (1 - m)) ** 2, (self.outer * (1 + m)) ** 2)
+            dlat = self.outer * (1 + m) / MILES_PER_DEGREE
+            dlon = dlat / max(self.cos_lat, 1e-6)
+            self.bbox = (self.lat - dlat, self.lon - dlon, self.lat + dlat, self.lon + dlon)
+            self.points = None
+        elif self.kind == "polygon":
+            self.points = [(float(lat), float(lon)) for lat, lon in spec["points"]]
+            if len(self.points) < 3:
+                raise ValueError(f"Zone {home_id}/{self.name}: a polygon needs at least 3 points")
+            lats, lons = [p[0] for p in self.points], [p[1] for p in self.points]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+            self.lat = self.lon = self.cos_lat = self.inner = self.outer = None
+            self.sure_inside = self.maybe_inside = None
+        else:
+            raise ValueError(f"Zone {home_id}/{self.name}: unknown type {self.kind!r}")
+    
+    def contains(self, lat, lon):
+        if not (self.bbox[0] <= lat <= self.bbox[2] and self.bbox[1] <= lon <= self.bbox[3]):
+            return False
+        if self.points is None:
+            dy = (lat - self.lat) * MILES_PER_DEGREE
+            dx = (lon - self.lon) * MILES_PER_DEGREE * self.cos_lat
+            d2 = dx * dx + dy * dy
+            if not self.maybe_inside[0] <= d2 <= self.maybe_inside[1]:
+                return False
+            if self.sure_inside[0] <= d2 <= self.sure_inside[1]:
+                return True
+            return self.inner <= haversine((lat, lon), (self.lat, self.lon)) <= self.outer
+        # Ray casting; polygons are small enough to treat lat/lon as planar
+        inside = False
+        points = self.points
+        j = len(points) - 1
+        for i in range(len(points)):
+            (lat_i, lon_i), (lat_j, lon_j) = points[i], points[j]
+            if (lon_i > lon) != (lon_j > lon) and lat < (lat_j - lat_i) * (lon - lon_i) / (lon_j - lon_i) + lat_i:
+                inside = not inside
+            j = i
+        return inside
+    
+    def applies(self, movement_trend):
+        return self.action is not None and (self.when is None or movement_trend in self.when)
+
+class ZoneIndex:
+    """Uniform grid over zone bounding boxes, keyed by home.
+    
+    Each zone is registered in every cell its bounding box touches, in configuration order, so a
+    lookup is one dict probe plus exact tests on the few zones sharing that cell; the first zone
+    (in the order configured) that contains the fix wins.
+    """
+    
+    def __init__(self, homes=None, cell_degrees=ZONE_GRID_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.cells = {}  # (home_id, row, col) -> [Zone, ...]
+        self.zones = 0
+        for home_id, home in (homes or {}).items():
+            for index, spec in enumerate(home.get("zones") or ()):
+                self.add(Zone(home_id, home, spec, index))
+    
+    def add(self, zone):
+        c = self.cell_degrees
+        for row in range(math.floor(zone.bbox[0] / c), math.floor(zone.bbox[2] / c) + 1):
+            for col in range(math.floor(zone.bbox[1] / c), math.floor(zone.bbox[3] / c) + 1):
+                self.cells.setdefault((zone.home_id, row, col), []).append(zone)
+        self.zones += 1
+    
+    def lookup(self, home_id, lat, lon):
+        """The first configured zone of home_id containing (lat, lon), or None."""
+        candidates = self.cells.get((home_id, math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)))
+        if candidates:
+            for zone in candidates:
+                if zone.contains(lat, lon):
+                    return zone
+        return None
+    
+    def get_stats(self):
+        return {"zones": self.zones, "cells": len(self.cells), "cell_degrees": self.cell_degrees}
+
+zone_index = ZoneIndex(HOMES)
+
+# Typed records
+def json_dumps(obj):
+    """Serialize a response body to UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode('utf-8')
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class Fix:
+    """One location fix in a device's history."""
+    
+    __slots__ = ("timestamp", "distance", "speed", "lat", "lon", "accuracy")
+    
+    def __init__(self, timestamp, distance, speed, lat, lon, accuracy=None):
+        self.timestamp = timestamp
+        self.distance = distance  # From the filtered position; lat/lon are the fix as received
+        self.speed = speed
+        self.lat = lat
+        self.lon = lon
+        self.accuracy = accuracy  # Reported accuracy in meters, if any
+    
+    def __repr__(self):
+        return f"Fix({self.timestamp}, {self.distance:.4f} mi, {self.speed} mph)"
+    
+    @classmethod
+    def from_dict(cls, data, now):
+        """Validate a fix from a request body (distance is set later); raises ValueError.
+        
+        A missing timestamp means now. History must stay in timestamp order, so fixes from the
+        future are rejected, apart from a few seconds of clock skew that is clamped to now.
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"Fix must be an object, got {type(data).__name__}")
+        lat, lon = _number(data, "lat", record="Fix"), _number(data, "lon", record="Fix")
+        if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            raise ValueError(f"Fix coordinates out of range: {lat}, {lon}")
+        timestamp = _number(data, "timestamp", now, record="Fix")
+        if timestamp > now + FIX_CLOCK_SKEW_SECONDS:
+            raise ValueError(f"Fix field 'timestamp' is {timestamp - now:.0f}s in the future")
+        accuracy = _number(data, "accuracy_m", optional=True, record="Fix")
+        if accuracy is not None and accuracy < 0:
+            raise ValueError(f"Fix field 'accuracy_m' must not be negative, got {accuracy}")
+        return cls(min(timestamp, now), None, _number(data, "speed_mph", 0, record="Fix"), lat, lon, accuracy)
+
+def _number(data, name, default=None, optional=False, record="Observation"):
+    value = data.get(name, default)
+    if value is None and optional:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f"{record} field '{name}' must be a finite number, got {value!r}")
+    return float(value)
+
+class Observation:
+    """Distance, speed and movement trend of a device after its latest fix - the decision input."""
+    
+    __slots__ = ("distance_miles", "speed_mph", "movement_trend", "radial_speed_mph", "eta_minutes", "history_samples",
+                 "zone", "zone_action", "position")
+    TRENDS = ("approaching", "moving_away", "stationary", "unknown")
+    
+    def __init__(self, distance_miles, speed_mph=0, movement_trend="unknown", radial_speed_mph=None,
+                 eta_minutes=None, history_samples=0, zone=None, position=None):
+        self.distance_miles = distance_miles
+        self.speed_mph = speed_mph
+        self.movement_trend = movement_trend
+        self.radial_speed_mph = radial_speed_mph
+        self.eta_minutes = eta_minutes
+        self.history_samples = history_samples
+        # Name of the geofence zone the fix is in, and its action if the zone's trend condition holds
+        self.zone = zone.name if zone is not None else None
+        self.zone_action = zone.action if zone is not None and zone.applies(movement_trend) else None
+        self.position = position  # Filtered position and velocity (PositionFilter.to_dict); not a decision input
+    
+    @classmethod
+    def from_dict(cls, data):
+        """Validate a mapping (a logged record, or a parsed JSON body); extra keys are ignored."""
+        if not isinstance(data, dict):
+            raise ValueError(f"Observation must be an object, got {type(data).__name__}")
+        trend = data.get("movement_trend", "unknown")
+        if trend not in cls.TRENDS:
+            raise ValueError(f"Observation field 'movement_trend' must be one of {cls.TRENDS}, got {trend!r}")
+        samples = data.get("history_samples", 0)
+        if isinstance(samples, bool) or not isinstance(samples, int) or samples < 0:
+            raise ValueError(f"Observation field 'history_samples' must be a non-negative integer, got {samples!r}")
+        distance = _number(data, "distance_miles")
+        if distance < 0:
+            raise ValueError(f"Observation field 'distance_miles' must not be negative, got {distance}")
+        zone, zone_action = data.get("zone"), data.get("zone_action")
+        if zone is not None and not isinstance(zone, str):
+            raise ValueError(f"Observation field 'zone' must be a string, got {zone!r}")
+        if zone_action is not None and zone_action not in ZONE_ACTIONS:
+            raise ValueError(f"Observation field 'zone_action' must be one of {ZONE_ACTIONS}, got {zone_action!r}")
+        obs = cls(distance, _number(data, "speed_mph", 0), trend, _number(data, "radial_speed_mph", optional=True),
+                  _number(data, "eta_minutes", optional=True), samples)
+        obs.zone, obs.zone_action = zone, zone_action
+        return obs
+    
+    @classmethod
+    def parse(cls, value):
+        """Accept an Observation, a mapping, or a JSON string/bytes of one."""
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, (str, bytes)):
+            try:
+                value = json_loads(value)
+            except ValueError as e:
+                raise ValueError(f"Observation is not valid JSON: {e}") from e
+        return cls.from_dict(value)
+    
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class Decision:
+    """Outcome of deciding on an observation; unset fields are left out of to_dict()."""
+    
+    __slots__ = ("action", "decision", "decided_by", "result", "delivery", "rule", "llm_decision", "escalation",
+                 "confidence", "model", "tokens", "cached_tokens", "degraded", "reason", "error")
+    
+    def __init__(self, action=None, decision=None, **fields):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.action = action
+        self.decision = decision
+        for name, value in fields.items():
+            setattr(self, name, value)
+    
+    def to_dict(self):
+        fields = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                fields[name] = value
+        return fields
+
+class LocationHistory:
+    """A device's fixes in timestamp order, as float columns with a hard capacity.
+    
+    Each fix costs 48 bytes across six array('d') columns (accuracy is NaN when unknown) instead of
+    a Fix object. Expired fixes are skipped by advancing a start offset and trimmed in bulk. When
+    the buffer is full, fixes older than the full-resolution window are thinned to the newest one
+    per time bucket, with buckets twice as wide for each doubling of age, and coarsened until a
+    quarter of the capacity is free. Memory per device stays bounded at any ping rate, and the most
+    detail is kept where the trend is decided.
+    """
+    
+    COLUMNS = ("timestamp", "distance", "speed", "lat", "lon", "accuracy")
+    
+    def __init__(self, capacity=HISTORY_CAPACITY, full_resolution_seconds=HISTORY_FULL_RESOLUTION_SECONDS,
+                 bucket_seconds=HISTORY_BUCKET_SECONDS):
+        self.capacity = max(capacity, 4)
+        self.full_resolution_seconds = max(full_resolution_seconds, 0.001)  # 0 would divide by zero in _compact
+        self.bucket_seconds = max(bucket_seconds, 0.001)
+        self.clear()
+    
+    def clear(self):
+        self.columns = tuple(array('d') for _ in self.COLUMNS)
+        self.timestamps, self.distances, self.speeds, self.lats, self.lons, self.accuracies = self.columns
+        self.start = 0
+    
+    def __len__(self):
+        return len(self.timestamps) - self.start
+    
+    def __getitem__(self, index):
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("history index out of range")
+        return self._fix(self.start + index)
+    
+    def __iter__(self):
+        for i in range(self.start, len(self.timestamps)):
+            yield self._fix(i)
     
-    avg_change = sum(distance_changes) / len(distance_changes)
+    def _fix(self, i):
+        accuracy = self.accuracies[i]
+        return Fix(self.timestamps[i], self.distances[i], self.speeds[i], self.lats[i], self.lons[i],
+                   None if math.isnan(accuracy) else accuracy)
     
-    # Threshold for considering significant movement (0.01 miles = ~53 feet)
-    MOVEMENT_THRESHOLD = 0.01
+    def points(self):
+        """(timestamp, distance) pairs, oldest first, without building Fix objects."""
+        return zip(self.timestamps[self.start:], self.distances[self.start:])
     
-    if avg_change < -MOVEMENT_THRESHOLD:
-        return "approaching"
-    elif avg_change > MOVEMENT_THRESHOLD:
-        return "moving_away"
-    else:
+    def append(self, fix):
+        if len(self) >= self.capacity:
+            self._compact()
+        self.timestamps.append(fix.timestamp)
+        self.distances.append(fix.distance)
+        self.speeds.append(fix.speed)
+        self.lats.append(fix.lat)
+        self.lons.append(fix.lon)
+        self.accuracies.append(math.nan if fix.accuracy is None else fix.accuracy)
+    
+    def extend(self, fixes):
+        for fix in fixes:
+            self.append(fix)
+    
+    def expire(self, cutoff_time):
+        """Drop fixes older than cutoff_time."""
+        timestamps, start = self.timestamps, self.start
+        while start < len(timestamps) and timestamps[start] < cutoff_time:
+            start += 1
+        self.start = start
+        # Trim once the dead prefix is as long as the live part, so each fix is moved O(1) times
+        if start and start * 2 >= len(timestamps):
+            for column in self.columns:
+                del column[:start]
+            self.start = 0
+    
+    def _compact(self):
+        timestamps = self.timestamps[self.start:]
+        size = len(timestamps)
+        target = self.capacity * 3 // 4
+        newest = timestamps[-1]
+        span = newest - timestamps[0]
+        horizon, width = self.full_resolution_seconds, self.bucket_seconds
+        while True:
+            first_recent = bisect.bisect_left(timestamps, newest - horizon)
+            keep, last_bucket = [], None
+            for i in range(first_recent):
+                timestamp = timestamps[i]
+                # Buckets double in width with each doubling of age past the window
+                tier = int(math.log2((newest - timestamp) / horizon))
+                bucket = (tier, timestamp // (width * 2 ** tier))
+                if bucket == last_bucket:
+                    keep[-1] = i  # Newest fix in the bucket stands for it
+                else:
+                    keep.append(i)
+                    last_bucket = bucket
+            keep.extend(range(first_recent, size))
+            if len(keep) <= target or width > span or horizon < 0.001:
+                break
+            # Coarsen older fixes first; shrink the window only once it holds over half the budget
+            if size - first_recent > target // 2:
+                horizon /= 2
+            else:
+                width *= 2
+        keep = keep[-target:]
+        metrics.inc("ac_agent_history_downsampled_total", size - len(keep))
+        self.columns = tuple(array('d', [column[self.start + i] for i in keep]) for column in self.columns)
+        self.timestamps, self.distances, self.speeds, self.lats, self.lons, self.accuracies = self.columns
+        self.start = 0
+    
+    def nbytes(self):
+        return sum(column.buffer_info()[1] * column.itemsize for column in self.columns)
+
+def cleanup_old_locations(history):
+    """Remove location history older than HISTORY_RETENTION_MINUTES."""
+    history.expire(time.time() - (HISTORY_RETENTION_MINUTES * 60))
+
+class TrendEstimator:
+    """Incremental movement trend: EWMA of radial velocity (change in distance over time) with ETA.
+    
+    Each fix updates the estimate in O(1); samples fade out with TREND_SMOOTHING_SECONDS rather
+    than being re-scanned, and the estimator resets once the whole history has expired.
+    """
+    
+    def __init__(self, smoothing_seconds=TREND_SMOOTHING_SECONDS, threshold_mph=TREND_THRESHOLD_MPH):
+        self.smoothing_seconds = smoothing_seconds
+        self.threshold_mph = threshold_mph
+        self.reset()
+    
+    def reset(self):
+        self.samples = 0
+        self.last_timestamp = None
+        self.last_distance = None
+        self.velocity_mph = None  # Negative = approaching home
+    
+    def update(self, timestamp, distance):
+        """Fold in a fix; fixes must arrive in timestamp order."""
+        if self.last_timestamp is not None:
+            dt = timestamp - self.last_timestamp
+            if dt < 0:
+                return
+            if dt > 0:
+                instant_mph = (distance - self.last_distance) / dt * 3600
+                if self.velocity_mph is None:
+                    self.velocity_mph = instant_mph
+                else:
+                    # Irregular sampling: weight the new reading by how much time it covers
+                    alpha = 1 - math.exp(-dt / self.smoothing_seconds)
+                    self.velocity_mph += alpha * (instant_mph - self.velocity_mph)
+        self.samples += 1
+        self.last_timestamp = timestamp
+        self.last_distance = distance
+    
+    def trend(self):
+        if self.samples < MIN_SAMPLES_FOR_TREND or self.velocity_mph is None:
+            return "unknown"
+        if self.velocity_mph < -self.threshold_mph:
+            return "approaching"
+        elif self.velocity_mph > self.threshold_mph:
+            return "moving_away"
         return "stationary"
+    
+    def eta_minutes(self):
+        """Minutes until arrival at the current approach speed, or None if not approaching."""
+        if self.trend() != "approaching":
+            return None
+        return self.last_distance / -self.velocity_mph * 60
+    
+    def observation(self, distance_miles, speed_mph, history_samples, zone=None, position=None):
+        return Observation(distance_miles, speed_mph, self.trend(), self.velocity_mph, self.eta_minutes(),
+                           history_samples, zone, position)
+
+METERS_PER_MILE = 1609.344
+
+class PositionFilter:
+    """Constant-velocity Kalman filter over a device's fixes, with accuracy-aware outlier rejection.
+    
+    Position is tracked in miles north/east of the first fix after a reset. With the same noise on
+    both axes the 4-state filter splits into two 2-state (position, velocity) filters that share one
+    covariance, so an update is a few dozen float operations. Each fix's reported accuracy is its
+    measurement noise; fixes whose innovation is more than GPS_OUTLIER_SIGMA standard deviations
+    out are rejected, and GPS_OUTLIER_RESET rejections in a row restart the filter at the new fix.
+    """
+    
+    INITIAL_SPEED_STD = 40 / METERS_PER_MILE  # mi/s (~90 mph) of velocity uncertainty at the first fix
+    
+    def __init__(self, enabled=GPS_FILTER_ENABLED, accel_noise=GPS_ACCEL_NOISE, outlier_sigma=GPS_OUTLIER_SIGMA,
+                 outlier_reset=GPS_OUTLIER_RESET, default_accuracy=GPS_DEFAULT_ACCURACY_M,
+                 max_accuracy=GPS_MAX_ACCURACY_M):
+        self.enabled = enabled
+        self.q = (accel_noise / METERS_PER_MILE) ** 2  # Acceleration spectral density, mi^2/s^3
+        self.gate = outlier_sigma ** 2
+        self.outlier_reset = outlier_reset
+        self.default_accuracy = default_accuracy
+        self.max_accuracy = max_accuracy
+        self.last_fix = None
+        self.accepted = True
+        self.reset()
+    
+    def reset(self):
+        self.timestamp = None
+        self.origin = None  # (lat, lon, miles per degree of longitude)
+        self.north = self.east = 0.0  # Miles from origin
+        self.v_north = self.v_east = 0.0  # mi/s
+        self.p00 = self.p01 = self.p11 = 0.0  # Shared per-axis covariance
+        self.rejected_in_row = 0
+    
+    def update(self, timestamp, lat, lon, accuracy_m=None):
+        """Fold in a fix; return False if it was rejected as an outlier or as too inaccurate."""
+        self.last_fix = (lat, lon)
+        if not self.enabled:
+            return True
+        if not accuracy_m or accuracy_m <= 0:
+            accuracy_m = self.default_accuracy
+        if accuracy_m > self.max_accuracy:
+            self.accepted = False
+            return False
+        r = (accuracy_m / METERS_PER_MILE) ** 2
+        if self.timestamp is None:
+            self._start(timestamp, lat, lon, r)
+            return True
+        
+        # Predict forward; out-of-order fixes are measured against the current state
+        dt = timestamp - self.timestamp
+        if dt > 0:
+            q = self.q
+            self.north += self.v_north * dt
+            self.east += self.v_east * dt
+            self.p00 += dt * (2 * self.p01 + dt * self.p11) + q * dt ** 3 / 3
+            self.p01 += dt * self.p11 + q * dt ** 2 / 2
+            self.p11 += q * dt
+            self.timestamp = timestamp
+        
+        origin_lat, origin_lon, miles_per_lon = self.origin
+        d_north = (lat - origin_lat) * MILES_PER_DEGREE - self.north
+        d_east = (lon - origin_lon) * miles_per_lon - self.east
+        s = self.p00 + r
+        if (d_north * d_north + d_east * d_east) / s > self.gate:
+            self.rejected_in_row += 1
+            if self.rejected_in_row >= self.outlier_reset:
+                # Persistent disagreement means the estimate is wrong, not the fixes
+                self._start(timestamp, lat, lon, r)
+                return True
+            self.accepted = False
+            return False
+        
+        k0, k1 = self.p00 / s, self.p01 / s
+        self.north += k0 * d_north
+        self.east += k0 * d_east
+        self.v_north += k1 * d_north
+        self.v_east += k1 * d_east
+        self.p11 -= k1 * self.p01
+        self.p00 *= 1 - k0
+        self.p01 *= 1 - k0
+        self.rejected_in_row = 0
+        self.accepted = True
+        return True
+    
+    def _start(self, timestamp, lat, lon, r):
+        self.reset()
+        self.timestamp = timestamp
+        self.origin = (lat, lon, MILES_PER_DEGREE * math.cos(math.radians(lat)))
+        self.p00 = r
+        self.p11 = self.INITIAL_SPEED_STD ** 2
+        self.accepted = True
+    
+    def position(self):
+        """Filtered (lat, lon), or the latest raw fix while there's no estimate."""
+        if not self.enabled or self.origin is None:
+            return self.last_fix
+        origin_lat, origin_lon, miles_per_lon = self.origin
+        return origin_lat + self.north / MILES_PER_DEGREE, origin_lon + self.east / miles_per_lon
+    
+    def to_dict(self):
+        """Filtered position and velocity for responses; None before the first fix."""
+        position = self.position()
+        if position is None:
+            return None
+        if not self.enabled or self.origin is None:
+            return {"lat": position[0], "lon": position[1], "accepted": self.accepted}
+        return {
+            "lat": position[0],
+            "lon": position[1],
+            "north_mph": self.v_north * 3600,
+            "east_mph": self.v_east * 3600,
+            "accuracy_m": math.sqrt(self.p00) * METERS_PER_MILE,
+            "accepted": self.accepted,
+        }
+
+# Per-device state
+class DeviceState:
+    """Location history, trend and idempotence state for one device at one home."""
+    
+    def __init__(self, home_id, device_id):
+        self.home_id = home_id
+        self.device_id = device_id
+        self.history = LocationHistory()
+        self.trend = TrendEstimator()
+        self.filter = PositionFilter()
+        self.last_decision = None  # Last delivered action, for idempotence
+        self.pending_decision = None  # Action queued for delivery but not yet confirmed
+        self.last_trend = None  # Previous movement trend, for trend-change escalation
+        self.last_seen = time.time()
+        self.lock = threading.Lock()  # Guards history and the decision check-and-act
+
+class DeviceStore:
+    """Map of (home_id, device_id) -> DeviceState, striped over independently locked shards."""
+    
+    def __init__(self, shards=STATE_SHARDS, max_devices=MAX_DEVICES, idle_ttl=DEVICE_IDLE_TTL_MINUTES * 60):
+        self.shards = [OrderedDict() for _ in range(shards)]  # Each shard kept in least-recently-seen order
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.max_per_shard = max(1, max_devices // shards)
+        self.idle_ttl = idle_ttl
+        self.evictions = 0
+    
+    def get(self, home_id=DEFAULT_HOME_ID, device_id=DEFAULT_DEVICE_ID):
+        """Return the state for a device, creating it on first sight."""
+        key = (home_id, device_id)
+        index = hash(key) % len(self.shards)
+        now = time.time()
+        with self.locks[index]:
+            shard = self.shards[index]
+            state = shard.get(key)
+            if state is None:
+                state = DeviceState(home_id, device_id)
+                shard[key] = state
+            else:
+                shard.move_to_end(key)
+            state.last_seen = now
+            self._evict(shard, now)
+        return state
+    
+    def _evict(self, shard, now):
+        # Oldest entries sit at the front; stop at the first one still active and within capacity
+        while shard:
+            oldest = next(iter(shard.values()))
+            if len(shard) <= self.max_per_shard and now - oldest.last_seen <= self.idle_ttl:
+                break
+            shard.popitem(last=False)
+            self.evictions += 1
+    
+    def get_stats(self):
+        return {
+            "devices": sum(len(shard) for shard in self.shards),
+            "shards": len(self.shards),
+            "evictions": self.evictions
+        }
+
+device_store = DeviceStore()
+
+# Durable state journal
+class StateJournal:
+    """Append-only SQLite log of pings and decisions, committed in batches by a background thread.
+    
+    WAL mode with synchronous=FULL fsyncs the log once per batch commit, so request threads never
+    wait on the disk and at most the last STATE_FLUSH_INTERVAL of pings is lost on power failure.
+    """
+    
+    def __init__(self, path=STATE_DB_PATH, flush_interval=STATE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.conn = None
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.last_prune = 0
+        self.stats = {"written": 0, "batches": 0, "errors": 0}
+    
+    @property
+    def enabled(self):
+        return self.conn is not None
+    
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pings (
+                home_id TEXT, device_id TEXT, timestamp REAL,
+                distance REAL, speed REAL, lat REAL, lon REAL, accuracy REAL
+            );
+            CREATE INDEX IF NOT EXISTS pings_timestamp ON pings (timestamp);
+            CREATE TABLE IF NOT EXISTS decisions (
+                home_id TEXT, device_id TEXT, timestamp REAL, decision TEXT
+            );
+        """)
+        # Journals written before accuracy was recorded; their rows replay without it
+        if "accuracy" not in [row[1] for row in self.conn.execute("PRAGMA table_info(pings)")]:
+            self.conn.execute("ALTER TABLE pings ADD COLUMN accuracy REAL")
+        self.thread = threading.Thread(target=self._run, name="state-journal", daemon=True)
+        self.thread.start()
+    
+    def record_ping(self, state, entry):
+        if self.conn is None:
+            return
+        row = (state.home_id, state.device_id, entry.timestamp, entry.distance, entry.speed, entry.lat, entry.lon,
+               entry.accuracy)
+        with self.cond:
+            self.pending.append(("ping", row))
+    
+    def record_decision(self, state, decision):
+        if self.conn is None:
+            return
+        with self.cond:
+            self.pending.append(("decision", (state.home_id, state.device_id, time.time(), decision)))
+    
+    def replay(self, store):
+        """Rebuild device history within the retention window and each device's last decision."""
+        start_time = time.time()
+        cutoff_time = start_time - (HISTORY_RETENTION_MINUTES * 60)
+        pings = 0
+        states = {}
+        
+        rows = self.conn.execute(
+            "SELECT home_id, device_id, timestamp, distance, speed, lat, lon, accuracy FROM pings "
+            "WHERE timestamp >= ? ORDER BY timestamp", (cutoff_time,))
+        for home_id, device_id, timestamp, distance, speed, lat, lon, accuracy in rows:
+            state = states.get((home_id, device_id))
+            if state is None:
+                state = states[(home_id, device_id)] = store.get(home_id, device_id)
+            state.history.append(Fix(timestamp, distance, speed, lat, lon, accuracy))
+            state.trend.update(timestamp, distance)
+            state.filter.update(timestamp, lat, lon, accuracy)  # Re-prime; these fixes were accepted when journaled
+            pings += 1
+        
+        # SQLite returns the row holding MAX(timestamp) for bare columns in the group
+        rows = self.conn.execute(
+            "SELECT home_id, device_id, decision, MAX(timestamp) FROM decisions GROUP BY home_id, device_id")
+        decisions = 0
+        for home_id, device_id, decision, _ in rows:
+            store.get(home_id, device_id).last_decision = decision
+            decisions += 1
+        
+        logger.info(f"💾 Replayed {pings} pings and {decisions} decisions in {(time.time() - start_time) * 1000:.1f} ms")
+        return pings, decisions
+    
+    def flush(self):
+        with self.cond:
+            batch, self.pending = self.pending, []
+        if not batch or self.conn is None:
+            return
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT INTO pings VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                      [row for kind, row in batch if kind == "ping"])
+                self.conn.executemany("INSERT INTO decisions VALUES (?, ?, ?, ?)",
+                                      [row for kind, row in batch if kind == "decision"])
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        except sqlite3.Error as e:
+            self.stats["errors"] += 1
+            logger.warning(f"⚠️ State journal write failed: {e}")
+    
+    def prune(self):
+        """Drop pings past retention and superseded decisions."""
+        cutoff_time = time.time() - (HISTORY_RETENTION_MINUTES * 60)
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM pings WHERE timestamp < ?", (cutoff_time,))
+                self.conn.execute(
+                    "DELETE FROM decisions WHERE timestamp < ? AND rowid NOT IN "
+                    "(SELECT MAX(rowid) FROM decisions GROUP BY home_id, device_id)", (cutoff_time,))
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ State journal prune failed: {e}")
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(timeout=5)
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait(timeout=self.flush_interval)
+                if self.closed:
+                    return
+            self.flush()
+            if time.time() - self.last_prune > 60:
+                self.prune()
+                self.last_prune = time.time()
+    
+    def get_stats(self):
+        with self.cond:
+            return {**self.stats, "pending": len(self.pending), "path": self.path if self.conn else None}
+
+state_journal = StateJournal()
+
+def record_location(state, loc, speed_mph, accuracy_m=None):
+    """Filter a fix into a device's location history and return the resulting observation.
+    
+    Distance and zone come from the filtered position; a fix the filter rejects isn't added to the
+    history or trend, and the observation reflects the filter's current estimate instead.
+    """
+    home = HOMES[state.home_id]
+    with state.lock:
+        start_time = time.perf_counter()
+        
+        # Clean up old location history
+        cleanup_old_locations(state.history)
+        if not state.history:
+            state.trend.reset()
+            state.filter.reset()
+        
+        now = time.time()
+        accepted = state.filter.update(now, loc[0], loc[1], accuracy_m)
+        lat, lon = state.filter.position()
+        filter_done = time.perf_counter()
+        metrics.observe("ac_agent_stage_seconds", filter_done - start_time, stage="filter")
+        metrics.inc("ac_agent_gps_fixes_total", result="accepted" if accepted else "rejected")
+        
+        dist = haversine((lat, lon), (home["lat"], home["lon"]))
+        haversine_done = time.perf_counter()
+        metrics.observe("ac_agent_stage_seconds", haversine_done - filter_done, stage="haversine")
+        zone = zone_index.lookup(state.home_id, lat, lon)
+        zone_done = time.perf_counter()
+        metrics.observe("ac_agent_stage_seconds", zone_done - haversine_done, stage="zone")
+        
+        if accepted:
+            # Add current location to history
+            location_entry = Fix(now, dist, speed_mph, loc[0], loc[1], accuracy_m)
+            state.history.append(location_entry)
+            state_journal.record_ping(state, location_entry)
+            history_done = time.perf_counter()
+            metrics.observe("ac_agent_stage_seconds", history_done - zone_done, stage="history")
+            
+            # Update movement trend incrementally
+            state.trend.update(now, dist)
+            metrics.observe("ac_agent_stage_seconds", time.perf_counter() - history_done, stage="trend")
+        
+        return state.trend.observation(dist, speed_mph, len(state.history), zone, state.filter.to_dict())
+
+def filter_fixes(state, entries, home):
+    """Run timestamp-ordered fixes through the device's filter; return the accepted ones with distances set."""
+    accepted, lats, lons = [], [], []
+    for entry in entries:
+        if state.filter.update(entry.timestamp, entry.lat, entry.lon, entry.accuracy):
+            lat, lon = state.filter.position()
+            accepted.append(entry)
+            lats.append(lat)
+            lons.append(lon)
+    rejected = len(entries) - len(accepted)
+    metrics.inc("ac_agent_gps_fixes_total", len(accepted), result="accepted")
+    if rejected:
+        metrics.inc("ac_agent_gps_fixes_total", rejected, result="rejected")
+    with metrics.timer("ac_agent_stage_seconds", stage="haversine"):
+        for entry, dist in zip(accepted, haversine_many(lats, lons, home)):
+            entry.distance = dist
+    return accepted
+
+def record_locations(state, fixes, home):
+    """Merge a batch of validated fixes (Fix.from_dict) into a device's history; observation reflects the newest fix."""
+    cutoff_time = time.time() - (HISTORY_RETENTION_MINUTES * 60)
+    entries = sorted((fix for fix in fixes if fix.timestamp >= cutoff_time), key=lambda fix: fix.timestamp)
+    
+    with state.lock:
+        cleanup_old_locations(state.history)
+        if not state.history:
+            state.trend.reset()
+            state.filter.reset()
+        
+        # Fast path: the batch is newer than everything we hold
+        if not state.history or not entries or entries[0].timestamp >= state.history[-1].timestamp:
+            with metrics.timer("ac_agent_stage_seconds", stage="filter"):
+                entries = filter_fixes(state, entries, home)
+            state.history.extend(entries)
+            for entry in entries:
+                state.trend.update(entry.timestamp, entry.distance)
+        else:
+            # Late fixes land mid-history, so refilter and rebuild the trend from the merged timeline
+            merged = list(heapq.merge(state.history, entries, key=lambda entry: entry.timestamp))
+            state.filter.reset()
+            state.trend.reset()
+            state.history.clear()
+            with metrics.timer("ac_agent_stage_seconds", stage="filter"):
+                state.history.extend(filter_fixes(state, merged, home))
+            for timestamp, distance in state.history.points():
+                state.trend.update(timestamp, distance)
+            entries = [entry for entry in entries if entry.distance is not None]
+        
+        for entry in entries:
+            state_journal.record_ping(state, entry)
+        
+        if not state.history:
+            return None, 0
+        
+        latest = state.history[-1]
+        zone = zone_index.lookup(state.home_id, *state.filter.position())
+        
+        return (state.trend.observation(latest.distance, latest.speed, len(state.history), zone,
+                                        state.filter.to_dict()), len(entries))
 
 # REAL Agents SDK Implementation (minimal but authentic)
 class FunctionTool:
@@ -200,7 +1777,7 @@ class Agent:
         self.model = model
         self.instructions = instructions
         self.tools = tools or []
-        self.last_decision = None  # For idempotence
+        self.prompt = DecisionPrompt(self)
     
     def get_tool_by_name(self, name):
         for tool in self.tools:
@@ -208,12 +1785,398 @@ class Agent:
                 return tool
         return None
 
+class DecisionPrompt:
+    """Chat request for an agent, compiled once with the static parts first.
+    
+    The system message (role, instructions and tool list) and the response schema are identical
+    on every call, so the provider can reuse its cached prefix; only the final user message, the
+    current observation, changes. The reply is constrained to an enum of the tool names plus
+    "no_action".
+    """
+    
+    def __init__(self, agent, structured=LLM_STRUCTURED_OUTPUT, max_tokens=LLM_MAX_TOKENS):
+        self.actions = [tool.name for tool in agent.tools] + ["no_action"]
+        tool_lines = "\n".join(f"- {tool.name}: {tool.description.strip()}" for tool in agent.tools)
+        self.system_message = {
+            "role": "system",
+            "content": (
+                "You are a smart AC controller. Follow the rules exactly.\n\n"
+                f"{agent.instructions.strip()}\n\n"
+                f"Available tools:\n{tool_lines}\n\n"
+                + ('Reply with JSON {"action": "<action>"} where action is one of: '
+                   if structured else "Respond with ONLY one of: ")
+                + ", ".join(self.actions) + "."
+            ),
+        }
+        self.request = {
+            "model": agent.model,
+            "max_tokens": max_tokens,
+            "temperature": 0,
+        }
+        if structured:
+            self.request["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "ac_decision",
+                    "strict": True,
+                    "schema": {
+                        "type": "object",
+                        "properties": {"action": {"type": "string", "enum": self.actions}},
+                        "required": ["action"],
+                        "additionalProperties": False,
+                    },
+                },
+            }
+    
+    def render(self, obs):
+        """Request body for one observation; everything before the last message is shared."""
+        eta = obs.eta_minutes
+        eta_text = f"{eta:.1f} minutes" if eta is not None else "n/a (not approaching)"
+        zone_text = f"- Zone: {obs.zone}\n" if obs.zone else ""
+        observation = (
+            "Current observation:\n"
+            f"- Distance from home: {obs.distance_miles:.3f} miles\n"
+            f"- Movement trend: {obs.movement_trend}\n"
+            f"{zone_text}"
+            f"- Speed: {obs.speed_mph} mph\n"
+            f"- Estimated time of arrival: {eta_text}"
+        )
+        return {**self.request, "messages": [self.system_message, {"role": "user", "content": observation}]}
+    
+    def parse(self, content):
+        """Action from a reply, accepting plain text from servers without structured output."""
+        text = (content or "").strip()
+        try:
+            action = json.loads(text).get("action", "")
+        except (ValueError, AttributeError):
+            action = text.strip('"').lower()
+        if action not in self.actions:
+            logger.warning(f"⚠️ Unrecognised LLM decision {content!r}, treating as no_action")
+            return "no_action"
+        return action
+
+class RulePolicy:
+    """Local, precompiled form of the agent instructions - evaluates in microseconds."""
+    
+    def __init__(self, home_radius=0.25, precool_radius=2.0, boundary_margin=None, escalate_on=None):
+        self.home_radius = home_radius
+        self.precool_radius = precool_radius
+        self.boundary_margin = RULES_BOUNDARY_MARGIN_MI if boundary_margin is None else boundary_margin
+        self.escalate_on = frozenset(RULES_ESCALATE_ON if escalate_on is None else escalate_on)
+        # Distance bands within boundary_margin of a threshold are treated as edge cases
+        self.boundary_bands = [(t - self.boundary_margin, t + self.boundary_margin)
+                               for t in (self.home_radius, self.precool_radius)]
+    
+    def evaluate(self, obs, previous_trend=None):
+        """Return (decision, rule, escalation_reason); escalation_reason is None when unambiguous."""
+        distance = obs.distance_miles
+        movement = obs.movement_trend
+        
+        # A configured zone action is explicit, so it wins and is never escalated
+        if obs.zone_action is not None:
+            return obs.zone_action, f"zone:{obs.zone}", None
+        
+        # Rules in the same order as agent.instructions
+        if distance < self.home_radius:
+            decision, rule = "no_action", "already_home"
+        elif distance <= self.precool_radius and movement == "approaching":
+            decision, rule = "ac_on", "approaching_within_range"
+        elif distance > self.precool_radius or movement == "moving_away":
+            decision, rule = "ac_off", "far_or_moving_away"
+        else:
+            decision, rule = "no_action", "hold"
+        
+        escalation = None
+        if "boundary" in self.escalate_on and any(lo <= distance <= hi for lo, hi in self.boundary_bands):
+            escalation = "boundary"
+        elif ("trend_change" in self.escalate_on and previous_trend not in (None, "unknown")
+              and previous_trend != movement):
+            escalation = "trend_change"
+        elif ("conflict" in self.escalate_on and distance > self.precool_radius
+              and movement in ("unknown", "stationary")):
+            escalation = "conflict"
+        
+        return decision, rule, escalation
+
+class DecisionCache:
+    """LRU + TTL cache of LLM decisions keyed on a quantized observation."""
+    
+    def __init__(self, max_entries=DECISION_CACHE_MAX_ENTRIES, ttl=DECISION_CACHE_TTL_SECONDS,
+                 distance_bucket=DECISION_CACHE_DISTANCE_BUCKET_MI, speed_bucket=DECISION_CACHE_SPEED_BUCKET_MPH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.distance_bucket = distance_bucket
+        self.speed_bucket = speed_bucket
+        self.entries = OrderedDict()  # key -> (expires_at, decision)
+        self.instruction_hashes = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+    
+    def key(self, obs, model, instructions):
+        """Bucketed distance, trend, speed band, model and a hash of the instructions."""
+        instructions_hash = self.instruction_hashes.get(instructions)
+        if instructions_hash is None:
+            instructions_hash = hashlib.sha256(instructions.encode('utf-8')).hexdigest()[:16]
+            self.instruction_hashes[instructions] = instructions_hash
+        return (
+            math.floor(obs.distance_miles / self.distance_bucket),
+            obs.movement_trend,
+            math.floor((obs.speed_mph or 0) / self.speed_bucket),
+            obs.zone,
+            model,
+            instructions_hash
+        )
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires_at, decision = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return decision
+    
+    def put(self, key, decision):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, decision)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            size = len(self.entries)
+        events.publish("cache", decision=decision, movement_trend=key[1], zone=key[3], model=key[4],
+                       distance_miles=key[0] * self.distance_bucket, ttl_seconds=self.ttl, size=size)
+    
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "size": len(self.entries),
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0.0
+            }
+
+class LearnedPolicy:
+    """Decision tree distilled from logged LLM decisions (trained by distill.py).
+    
+    The tree is stored flat, as parallel per-node lists, so a prediction is a handful of
+    comparisons. Each leaf carries a confidence; below min_confidence the caller defers to the LLM.
+    """
+    
+    FORMAT = "ac-agent-tree/1"
+    FEATURES = ("distance_miles", "speed_mph", "radial_speed_mph", "eta_minutes",
+                "approaching", "moving_away", "stationary")
+    TRENDS = ("approaching", "moving_away", "stationary")
+    
+    def __init__(self, model, min_confidence=LEARNED_POLICY_MIN_CONFIDENCE):
+        if model.get("format") != self.FORMAT or tuple(model.get("features", ())) != self.FEATURES:
+            raise ValueError(f"Unsupported model format: {model.get('format')}")
+        self.model = model
+        self.min_confidence = min_confidence
+        self.classes = model["classes"]
+        self.feature = model["feature"]  # -1 marks a leaf
+        self.threshold = model["threshold"]
+        self.left = model["left"]
+        self.right = model["right"]
+        self.label = model["label"]
+        self.confidence = model["confidence"]
+        self.lock = threading.Lock()
+        self.stats = {"confident": 0, "deferred": 0}
+    
+    @classmethod
+    def load(cls, path, min_confidence=LEARNED_POLICY_MIN_CONFIDENCE):
+        with open(path) as f:
+            return cls(json.load(f), min_confidence)
+    
+    @classmethod
+    def features(cls, obs):
+        eta = obs.eta_minutes
+        trend = obs.movement_trend
+        return (
+            float(obs.distance_miles),
+            float(obs.speed_mph or 0),
+            float(obs.radial_speed_mph or 0),
+            -1.0 if eta is None else float(eta),
+        ) + tuple(1.0 if trend == t else 0.0 for t in cls.TRENDS)
+    
+    def predict(self, obs):
+        """Return (decision, confidence) for an observation."""
+        x = self.features(obs)
+        node = 0
+        while self.feature[node] >= 0:
+            node = self.left[node] if x[self.feature[node]] <= self.threshold[node] else self.right[node]
+        return self.classes[self.label[node]], self.confidence[node]
+    
+    def decide(self, obs):
+        """Return (decision, confidence), with decision None when the LLM should decide instead."""
+        decision, confidence = self.predict(obs)
+        confident = confidence >= self.min_confidence
+        with self.lock:
+            self.stats["confident" if confident else "deferred"] += 1
+        return (decision if confident else None), confidence
+    
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        total = stats["confident"] + stats["deferred"]
+        return {**stats, "coverage": stats["confident"] / total if total else 0.0,
+                "min_confidence": self.min_confidence, "nodes": len(self.feature),
+                "trained_samples": self.model.get("samples"), "holdout_agreement": self.model.get("agreement")}
+
+def load_learned_policy(path=LEARNED_POLICY_PATH):
+    if not path:
+        return None
+    try:
+        return LearnedPolicy.load(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"⚠️ Learned policy not loaded from {path}: {e}")
+        return None
+
+class DecisionLog:
+    """Append-only JSONL of observations and the LLM's decisions - training data for distill.py.
+    
+    Past max_mb the file is rotated to <path>.1 (replacing the previous one), so at most twice
+    that is kept on disk; distill.py accepts both files.
+    """
+    
+    FIELDS = ("distance_miles", "speed_mph", "movement_trend", "radial_speed_mph", "eta_minutes")
+    
+    def __init__(self, path=LLM_DECISION_LOG, max_mb=LLM_DECISION_LOG_MAX_MB):
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self.file = None
+        self.lock = threading.Lock()
+    
+    def record(self, obs, decision, model):
+        if not self.path:
+            return
+        line = json.dumps({**{field: getattr(obs, field) for field in self.FIELDS},
+                           "decision": decision, "model": model, "timestamp": time.time()})
+        with self.lock:
+            try:
+                if self.file is not None and self.file.tell() >= self.max_bytes:
+                    self.file.close()
+                    self.file = None
+                    os.replace(self.path, self.path + ".1")
+                if self.file is None:
+                    self.file = open(self.path, "a", buffering=1)
+                self.file.write(line + "\n")
+            except OSError as e:
+                logger.warning(f"⚠️ LLM decision log write failed: {e}")
+
+decision_log = DecisionLog()
+
 class Runner:
-    def __init__(self):
-        pass
+    MODES = ("rules", "hybrid", "llm")
+    
+    def __init__(self, mode=None, policy=None, cache=None, learned=None):
+        self.mode = (mode or DECISION_MODE).strip().lower()
+        if self.mode not in self.MODES:
+            # Anything else would quietly take the hybrid path with the learned policy off
+            raise ValueError(f"DECISION_MODE must be one of {self.MODES}, got {mode or DECISION_MODE!r}")
+        self.policy = policy or RulePolicy()
+        self.cache = cache if cache is not None else (DecisionCache() if DECISION_CACHE_ENABLED else None)
+        self.learned = learned if learned is not None else load_learned_policy()
+    
+    def run(self, agent, observation, parent_run_id=None, state=None):
+        """Decide and execute, counting the outcome"""
+        ids = {"home_id": state.home_id, "device_id": state.device_id} if state is not None else {}
+        if events.subscribers and isinstance(observation, Observation):
+            events.publish("observation", **ids, **observation.to_dict())
+        result = self.decide(agent, observation, parent_run_id=parent_run_id, state=state)
+        metrics.inc("ac_agent_decisions_total", action=result.action or "error",
+                    decided_by=result.decided_by or "unknown")
+        if events.subscribers:
+            events.publish("decision", **ids, **result.to_dict())
+        return result
+    
+    def decide(self, agent, observation, parent_run_id=None, state=None):
+        """Decide with the local rules and/or a REAL OpenAI LLM call, then execute the decision"""
+        state = state or device_store.get()
+        
+        # Validate observations arriving as dicts or JSON (raises ValueError)
+        obs_data = Observation.parse(observation)
+        movement = obs_data.movement_trend
+        
+        with state.lock:
+            previous_trend = state.last_trend
+            state.last_trend = movement
+        
+        # A zone action is explicit and is applied by the rules in every mode, llm included
+        if self.mode != "llm" or obs_data.zone_action is not None:
+            start_time = time.time()
+            decision, rule, escalation = self.policy.evaluate(obs_data, previous_trend)
+            rule_duration = time.time() - start_time
+            metrics.observe("ac_agent_stage_seconds", rule_duration, stage="rules")
+            
+            if self.mode == "rules" or escalation is None:
+                logger.info(f"📏 Rule engine decision: '{decision}' ({rule})")
+                rule_run_id = tracer.create_run(
+                    name="AC_Agent_Rule_Decision",
+                    inputs={
+                        "agent_name": agent.name,
+                        "observation": obs_data.to_dict(),
+                        "mode": self.mode
+                    },
+                    run_type="chain",
+                    parent_run_id=parent_run_id
+                )
+                tracer.update_run(rule_run_id,
+                    outputs={"decision": decision, "rule": rule, "decided_by": "rules"},
+                    metadata={"duration_seconds": rule_duration, "mode": self.mode}
+                )
+                return self.execute(agent, state, decision, parent_run_id=rule_run_id,
+                                    decided_by="rules", rule=rule, tokens=0)
+            
+            logger.info(f"📏 Escalating to LLM ({escalation})")
+        
+        result = None
+        if self.learned is not None and self.mode == "hybrid":
+            result = self.run_learned(agent, state, obs_data, parent_run_id=parent_run_id)
+        if result is None:
+            result = self.run_llm(agent, state, obs_data, parent_run_id=parent_run_id, previous_trend=previous_trend)
+        if self.mode == "hybrid":
+            result.escalation = escalation
+        return result
+    
+    def run_learned(self, agent, state, obs_data, parent_run_id=None):
+        """Decide with the distilled model; None when it isn't confident enough and the LLM should"""
+        start_time = time.time()
+        decision, confidence = self.learned.decide(obs_data)
+        learned_duration = time.time() - start_time
+        metrics.observe("ac_agent_stage_seconds", learned_duration, stage="learned")
+        
+        if decision is None:
+            logger.info(f"🧠 Learned policy unsure ({confidence:.2f}), deferring to LLM")
+            return None
+        
+        logger.info(f"🧠 Learned policy decision: '{decision}' ({confidence:.2f})")
+        learned_run_id = tracer.create_run(
+            name="AC_Agent_Learned_Decision",
+            inputs={
+                "agent_name": agent.name,
+                "observation": obs_data.to_dict(),
+                "mode": self.mode
+            },
+            run_type="chain",
+            parent_run_id=parent_run_id
+        )
+        tracer.update_run(learned_run_id,
+            outputs={"decision": decision, "confidence": confidence, "decided_by": "learned"},
+            metadata={"duration_seconds": learned_duration, "min_confidence": self.learned.min_confidence}
+        )
+        return self.execute(agent, state, decision, parent_run_id=learned_run_id,
+                            decided_by="learned", confidence=confidence, tokens=0)
     
-    def run(self, agent, observation, parent_run_id=None):
-        """Run the agent with REAL OpenAI LLM call"""
+    def run_llm(self, agent, state, obs_data, parent_run_id=None, previous_trend=None):
+        """Ask the REAL OpenAI LLM for a decision and execute it"""
         logger.info("🤖 Running REAL Agent with OpenAI LLM...")
         
         # Create LangSmith trace for LLM decision
@@ -222,38 +2185,33 @@ class Runner:
             inputs={
                 "agent_name": agent.name,
                 "model": agent.model,
-                "observation": observation,
+                "observation": obs_data.to_dict(),
                 "instructions": agent.instructions
             },
             run_type="llm",
             parent_run_id=parent_run_id
         )
         
+        # Serve repeated observations from the decision cache
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(obs_data, agent.model, agent.instructions)
+            decision = self.cache.get(cache_key)
+            if decision is not None:
+                logger.info(f"🗃️ Cached LLM decision: '{decision}'")
+                tracer.update_run(llm_run_id,
+                    outputs={"decision": decision, "decided_by": "llm_cache"},
+                    metadata={"cache_hit": True, "total_tokens": 0, "model": agent.model}
+                )
+                return self.execute(agent, state, decision, parent_run_id=llm_run_id,
+                                    decided_by="llm_cache", llm_decision=decision, tokens=0, cached_tokens=0)
+        
         if not OPENAI_API_KEY:
             error_msg = "OpenAI API key not configured"
             logger.error(f"❌ {error_msg}")
             tracer.update_run(llm_run_id, error=error_msg)
-            return {"error": error_msg}
-        
-        # Parse observation
-        obs_data = eval(observation) if isinstance(observation, str) else observation
-        distance = obs_data.get("distance_miles", 0)
-        movement = obs_data.get("movement_trend", "unknown")
-        speed = obs_data.get("speed_mph", 0)
-        
-        # Create LLM prompt with exact same instructions as main.py
-        prompt = f"""
-{agent.instructions}
-
-Current observation:
-- Distance from home: {distance:.3f} miles
-- Movement trend: {movement}
-- Speed: {speed} mph
-
-Available tools: {[tool.name for tool in agent.tools]}
-
-Based on these rules, what action should I take? Respond with ONLY the tool name (ac_on, ac_off) or "no_action".
-"""
+            return self.degrade(agent, state, obs_data, previous_trend, "not_configured",
+                                parent_run_id=llm_run_id, error=error_msg)
         
         try:
             # REAL OpenAI API call
@@ -262,44 +2220,46 @@ Based on these rules, what action should I take? Respond with ONLY the tool name
                 "Content-Type": "application/json"
             }
             
-            data = {
-                "model": agent.model,
-                "messages": [
-                    {"role": "system", "content": "You are a smart AC controller. Follow the rules exactly."},
-                    {"role": "user", "content": prompt}
-                ],
-                "max_tokens": 50,
-                "temperature": 0.1
-            }
+            data = agent.prompt.render(obs_data)
             
             logger.info(f"🌐 Making REAL OpenAI API call to {agent.model}...")
             start_time = time.time()
             
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
+            # Hedged after a slow-call percentile and bounded by LLM_DEADLINE_SECONDS
+            response, role, model = llm_caller.post(
+                f"{OPENAI_BASE_URL}/chat/completions",
                 headers=headers,
-                json=data,
-                timeout=30
+                json=data
             )
             
             llm_duration = time.time() - start_time
+            metrics.observe("ac_agent_stage_seconds", llm_duration, stage="llm")
             
             if response.status_code == 200:
                 result = response.json()
-                decision = result["choices"][0]["message"]["content"].strip().lower()
+                decision = agent.prompt.parse(result["choices"][0]["message"]["content"])
                 
                 # Extract usage info for cost tracking
                 usage = result.get("usage", {})
                 prompt_tokens = usage.get("prompt_tokens", 0)
                 completion_tokens = usage.get("completion_tokens", 0)
                 total_tokens = usage.get("total_tokens", 0)
+                cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+                metrics.inc("ac_agent_llm_tokens_total", prompt_tokens, kind="prompt")
+                metrics.inc("ac_agent_llm_tokens_total", cached_tokens, kind="cached_prompt")
+                metrics.inc("ac_agent_llm_tokens_total", completion_tokens, kind="completion")
+                
+                logger.info(f"🤖 REAL LLM Response: '{decision}'" + (f" (hedge, {model})" if role == "hedge" else ""))
+                decision_log.record(obs_data, decision, model)
                 
-                logger.info(f"🤖 REAL LLM Response: '{decision}'")
+                if cache_key is not None:
+                    self.cache.put(cache_key, decision)
                 
                 # Update LangSmith trace with LLM results
                 tracer.update_run(llm_run_id, 
                     outputs={
                         "decision": decision,
+                        "decided_by": "llm",
                         "raw_response": result["choices"][0]["message"]["content"]
                     },
                     metadata={
@@ -307,69 +2267,103 @@ Based on these rules, what action should I take? Respond with ONLY the tool name
                         "prompt_tokens": prompt_tokens,
                         "completion_tokens": completion_tokens,
                         "total_tokens": total_tokens,
-                        "model": agent.model
+                        "cached_tokens": cached_tokens,
+                        "model": model,
+                        "hedged": role == "hedge",
+                        "cache_hit": False
                     }
                 )
                 
-                # Execute the decision
-                action_result = None
-                if decision == "ac_on" and agent.last_decision != "ac_on":
-                    tool = agent.get_tool_by_name("ac_on")
-                    if tool:
-                        action_result = tool(parent_run_id=llm_run_id)
-                        agent.last_decision = "ac_on"
-                        return {"action": "ac_on", "result": action_result, "llm_decision": decision, "tokens": total_tokens}
-                
-                elif decision == "ac_off" and agent.last_decision != "ac_off":
-                    tool = agent.get_tool_by_name("ac_off")
-                    if tool:
-                        action_result = tool(parent_run_id=llm_run_id)
-                        agent.last_decision = "ac_off"
-                        return {"action": "ac_off", "result": action_result, "llm_decision": decision, "tokens": total_tokens}
-                
-                else:
-                    logger.info("🤖 No action taken (idempotence or no_action)")
-                    return {"action": "no_action", "llm_decision": decision, "tokens": total_tokens}
+                return self.execute(agent, state, decision, parent_run_id=llm_run_id, decided_by="llm",
+                                    llm_decision=decision, model=model, tokens=total_tokens,
+                                    cached_tokens=cached_tokens)
                     
             else:
                 error_msg = f"OpenAI API error: {response.status_code} {response.text}"
+                metrics.inc("ac_agent_errors_total", service="openai")
                 logger.error(f"❌ {error_msg}")
                 tracer.update_run(llm_run_id, error=error_msg)
-                return {"error": error_msg}
+                return self.degrade(agent, state, obs_data, previous_trend, "llm_error",
+                                    parent_run_id=llm_run_id, error=error_msg)
+        
+        except ServiceUnavailable as e:
+            # Shed rather than wait on a failing or saturated upstream
+            logger.warning(f"⚡ {e}, using local rules")
+            tracer.update_run(llm_run_id, error=str(e))
+            return self.degrade(agent, state, obs_data, previous_trend, e.reason, parent_run_id=llm_run_id)
                 
         except Exception as e:
             error_msg = f"LLM call failed: {e}"
+            metrics.inc("ac_agent_errors_total", service="openai")
             logger.error(f"❌ {error_msg}")
             tracer.update_run(llm_run_id, error=error_msg)
-            return {"error": error_msg}
+            return self.degrade(agent, state, obs_data, previous_trend, "llm_error",
+                                parent_run_id=llm_run_id, error=error_msg)
+    
+    def degrade(self, agent, state, obs_data, previous_trend, reason, parent_run_id=None, error=None):
+        """Decide with the local rules when the LLM can't be used"""
+        decision, rule, _ = self.policy.evaluate(obs_data, previous_trend)
+        logger.info(f"📏 Degraded to rule engine ({reason}): '{decision}' ({rule})")
+        return self.execute(agent, state, decision, parent_run_id=parent_run_id, decided_by="rules_fallback",
+                            rule=rule, tokens=0, degraded=reason, error=error)
+    
+    def execute(self, agent, state, decision, parent_run_id=None, **fields):
+        """Queue a decision for delivery, honouring the device's idempotence state"""
+        # Locked so concurrent pings for a device can't queue the same action twice
+        with state.lock:
+            target = state.pending_decision or state.last_decision
+            enqueue = (decision in ("ac_on", "ac_off") and target != decision
+                       and agent.get_tool_by_name(decision) is not None)
+            if enqueue:
+                state.pending_decision = decision
+        
+        if enqueue:
+            command = actuation_queue.submit(agent, state, decision, parent_run_id=parent_run_id,
+                                             sampled=tracer.is_sampled(parent_run_id),
+                                             decided_by=fields.get("decided_by"))
+            if ACTUATION_ASYNC:
+                return Decision(decision, decision, result="queued for delivery", **fields)
+            command.done.wait(ACTUATION_WAIT_SECONDS)
+            return Decision(decision, decision, result=command.result or command.status,
+                            delivery=command.status, **fields)
+        
+        logger.info("🤖 No action taken (idempotence or no_action)")
+        return Decision("no_action", decision, **fields)
+
+class ActuationError(Exception):
+    """An AC tool could not confirm delivery to IFTTT."""
 
 # REAL Function Tools (same as main.py) with LangSmith tracing
 @function_tool
-def ac_on(parent_run_id=None):
+def ac_on(parent_run_id=None, home=None, sampled=None, decided_by=None):
     """Turn AC on using IFTTT webhook."""
-    logger.info("🔥 AC ON decision triggered by REAL LLM")
+    decided_by = decided_by or "unknown"
+    logger.info(f"🔥 AC ON decision triggered by {decided_by}")
+    event = (home or {}).get("ac_on_event", IFTTT_AC_ON_EVENT)
     
     # Create LangSmith trace for AC action
     action_run_id = tracer.create_run(
         name="AC_Turn_On_Action",
-        inputs={"action": "ac_on", "trigger": "llm_decision"},
+        inputs={"action": "ac_on", "trigger": f"{decided_by}_decision", "event": event},
         run_type="tool",
-        parent_run_id=parent_run_id
+        parent_run_id=parent_run_id,
+        sampled=sampled  # Delivery is async; the parent run has usually closed by now
     )
     
     if not IFTTT_KEY:
         error_msg = "IFTTT key not configured"
         logger.error(error_msg)
         tracer.update_run(action_run_id, error=error_msg)
-        return error_msg
+        raise ActuationError(error_msg)
     
     try:
         start_time = time.time()
-        response = requests.post(
-            f"https://maker.ifttt.com/trigger/{IFTTT_AC_ON_EVENT}/with/key/{IFTTT_KEY}",
-            json={"value1": "llm_triggered"}
+        response = http_clients["ifttt"].post(
+            f"{IFTTT_BASE_URL}/trigger/{event}/with/key/{IFTTT_KEY}",
+            json={"value1": f"{decided_by}_triggered"}
         )
         duration = time.time() - start_time
+        metrics.observe("ac_agent_stage_seconds", duration, stage="ifttt")
         
         response.raise_for_status()
         success_msg = "AC turned on via IFTTT"
@@ -379,7 +2373,7 @@ def ac_on(parent_run_id=None):
             outputs={"status": "success", "message": success_msg},
             metadata={
                 "duration_seconds": duration,
-                "ifttt_event": IFTTT_AC_ON_EVENT,
+                "ifttt_event": event,
                 "response_code": response.status_code
             }
         )
@@ -388,36 +2382,41 @@ def ac_on(parent_run_id=None):
         
     except Exception as e:
         error_msg = f"Failed to turn on AC: {e}"
+        metrics.inc("ac_agent_errors_total", service="ifttt")
         logger.error(f"❌ {error_msg}")
         tracer.update_run(action_run_id, error=error_msg)
-        return error_msg
+        raise ActuationError(error_msg) from e
 
 @function_tool
-def ac_off(parent_run_id=None):
+def ac_off(parent_run_id=None, home=None, sampled=None, decided_by=None):
     """Turn AC off using IFTTT webhook."""
-    logger.info("❄️ AC OFF decision triggered by REAL LLM")
+    decided_by = decided_by or "unknown"
+    logger.info(f"❄️ AC OFF decision triggered by {decided_by}")
+    event = (home or {}).get("ac_off_event", IFTTT_AC_OFF_EVENT)
     
     # Create LangSmith trace for AC action
     action_run_id = tracer.create_run(
         name="AC_Turn_Off_Action",
-        inputs={"action": "ac_off", "trigger": "llm_decision"},
+        inputs={"action": "ac_off", "trigger": f"{decided_by}_decision", "event": event},
         run_type="tool",
-        parent_run_id=parent_run_id
+        parent_run_id=parent_run_id,
+        sampled=sampled  # Delivery is async; the parent run has usually closed by now
     )
     
     if not IFTTT_KEY:
         error_msg = "IFTTT key not configured"
         logger.error(error_msg)
         tracer.update_run(action_run_id, error=error_msg)
-        return error_msg
+        raise ActuationError(error_msg)
     
     try:
         start_time = time.time()
-        response = requests.post(
-            f"https://maker.ifttt.com/trigger/{IFTTT_AC_OFF_EVENT}/with/key/{IFTTT_KEY}",
-            json={"value1": "llm_triggered"}
+        response = http_clients["ifttt"].post(
+            f"{IFTTT_BASE_URL}/trigger/{event}/with/key/{IFTTT_KEY}",
+            json={"value1": f"{decided_by}_triggered"}
         )
         duration = time.time() - start_time
+        metrics.observe("ac_agent_stage_seconds", duration, stage="ifttt")
         
         response.raise_for_status()
         success_msg = "AC turned off via IFTTT"
@@ -427,7 +2426,7 @@ def ac_off(parent_run_id=None):
             outputs={"status": "success", "message": success_msg},
             metadata={
                 "duration_seconds": duration,
-                "ifttt_event": IFTTT_AC_OFF_EVENT,
+                "ifttt_event": event,
                 "response_code": response.status_code
             }
         )
@@ -436,9 +2435,184 @@ def ac_off(parent_run_id=None):
         
     except Exception as e:
         error_msg = f"Failed to turn off AC: {e}"
+        metrics.inc("ac_agent_errors_total", service="ifttt")
         logger.error(f"❌ {error_msg}")
         tracer.update_run(action_run_id, error=error_msg)
-        return error_msg
+        raise ActuationError(error_msg) from e
+
+class ActuationCommand:
+    """One queued AC action for a device; `done` is set once it is delivered, dropped or failed."""
+    
+    def __init__(self, agent, state, decision, parent_run_id=None, sampled=True, decided_by=None):
+        self.agent = agent
+        self.state = state
+        self.decision = decision
+        self.decided_by = decided_by  # Decision source (rules, learned, llm_cache, llm, ...) for the AC tool
+        self.parent_run_id = parent_run_id
+        self.sampled = sampled  # Parent trace's head-sampling decision, captured while it's known
+        self.queued_at = time.time()
+        self.status = "queued"  # queued, delivered, superseded, skipped or failed
+        self.result = None
+        self.done = threading.Event()
+    
+    def finish(self, status, result=None):
+        self.status = status
+        self.result = result
+        self.done.set()
+
+class ActuationQueue:
+    """Per-device AC commands delivered to IFTTT by background workers.
+    
+    Only the newest command waiting for a device is kept, so one that is superseded before it is
+    sent (on, then off) is dropped, and a command matching what was last delivered is skipped.
+    Each device has at most one delivery in flight. A device's last_decision (and the journal)
+    only changes once the webhook confirms delivery.
+    """
+    
+    def __init__(self, workers=ACTUATION_WORKERS, max_attempts=ACTUATION_MAX_ATTEMPTS,
+                 backoff=ACTUATION_RETRY_BACKOFF):
+        self.workers = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.pending = {}  # (home_id, device_id) -> newest undelivered ActuationCommand
+        self.ready = deque()  # Keys with a pending command and nothing in flight
+        self.in_flight = set()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.threads = []
+        self.stats = {"queued": 0, "delivered": 0, "superseded": 0, "skipped": 0, "failed": 0, "retries": 0}
+        metrics.gauge("ac_agent_actuation_queue_depth", self.depth)
+    
+    def start(self):
+        with self.cond:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"actuation-{len(self.threads)}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+    
+    def submit(self, agent, state, decision, parent_run_id=None, sampled=True, decided_by=None):
+        """Queue a decision for delivery and return its ActuationCommand without waiting."""
+        if not self.threads:
+            self.start()
+        command = ActuationCommand(agent, state, decision, parent_run_id, sampled, decided_by)
+        key = (state.home_id, state.device_id)
+        with self.cond:
+            replaced = self.pending.get(key)
+            if replaced is not None:
+                self._finish(replaced, "superseded")
+            elif key not in self.in_flight:
+                self.ready.append(key)
+            self.pending[key] = command
+            self.stats["queued"] += 1
+            self.cond.notify()
+        return command
+    
+    def depth(self):
+        with self.cond:
+            return len(self.pending) + len(self.in_flight)
+    
+    def flush(self, timeout=10):
+        """Wait until every queued command has been delivered, dropped or given up on."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending and not self.in_flight, timeout=timeout)
+    
+    def close(self, timeout=10):
+        self.flush(timeout)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    
+    def _finish(self, command, status, result=None):
+        self.stats[status] += 1
+        metrics.inc("ac_agent_actuations_total", action=command.decision, status=status)
+        if status == "delivered":
+            metrics.observe("ac_agent_actuation_delivery_seconds", time.time() - command.queued_at)
+        command.finish(status, result)
+        if events.subscribers:
+            events.publish("actuation", home_id=command.state.home_id, device_id=command.state.device_id,
+                           action=command.decision, status=status, seconds=time.time() - command.queued_at,
+                           error=result if status == "failed" else None)
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or self.ready)
+                if not self.ready:
+                    return
+                key = self.ready.popleft()
+                command = self.pending.pop(key)
+                self.in_flight.add(key)
+            
+            try:
+                self._deliver(key, command)
+            except Exception as e:
+                logger.error(f"❌ Actuation worker error: {e}")
+                with self.cond:
+                    self._finish(command, "failed", str(e))
+            
+            with self.cond:
+                self.in_flight.discard(key)
+                if key in self.pending:
+                    self.ready.append(key)
+                self.cond.notify_all()
+    
+    def _superseded(self, key):
+        with self.cond:
+            return key in self.pending
+    
+    def _deliver(self, key, command):
+        state, decision = command.state, command.decision
+        with state.lock:
+            if decision == state.last_decision:
+                # Collapsed back to what the AC was last told, e.g. off -> on -> off before sending
+                if state.pending_decision == decision:
+                    state.pending_decision = None
+                with self.cond:
+                    self._finish(command, "skipped")
+                return
+        
+        tool = command.agent.get_tool_by_name(decision)
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                if self._superseded(key):
+                    with self.cond:
+                        self._finish(command, "superseded", str(error))
+                    return
+                with self.cond:
+                    self.stats["retries"] += 1
+                time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            try:
+                result = tool(parent_run_id=command.parent_run_id, home=HOMES.get(state.home_id),
+                              sampled=command.sampled, decided_by=command.decided_by)
+            except ActuationError as e:
+                error = e
+                continue
+            
+            with state.lock:
+                state.last_decision = decision
+                if state.pending_decision == decision:
+                    state.pending_decision = None
+            state_journal.record_decision(state, decision)
+            with self.cond:
+                self._finish(command, "delivered", result)
+            return
+        
+        # Give up; clearing the pending action lets the next ping decide and queue it again
+        logger.error(f"❌ Giving up on {decision} for {state.home_id}/{state.device_id} after "
+                     f"{self.max_attempts} attempts: {error}")
+        with state.lock:
+            if state.pending_decision == decision:
+                state.pending_decision = None
+        with self.cond:
+            self._finish(command, "failed", str(error))
+    
+    def get_stats(self):
+        with self.cond:
+            return {**self.stats, "depth": len(self.pending) + len(self.in_flight),
+                    "in_flight": len(self.in_flight), "workers": len(self.threads)}
+
+actuation_queue = ActuationQueue()
 
 # Create the REAL Agent with LLM (exactly like main.py)
 agent = Agent(
@@ -458,89 +2632,1085 @@ agent = Agent(
 # Create the REAL Runner
 runner = Runner()
 
+def process_ping(payload, endpoint="/ping"):
+    """Run one location fix through history, trend, decision and tracing; return the response body."""
+    fix = Fix.from_dict(payload, time.time())  # Raises ValueError for a malformed fix
+    home_id = str(payload.get("home_id", DEFAULT_HOME_ID))
+    device_id = str(payload.get("device_id", DEFAULT_DEVICE_ID))
+    home = HOMES.get(home_id)
+    if home is None:
+        raise ValueError(f"Unknown home_id: {home_id}")
+    home_coords = (home["lat"], home["lon"])
+    
+    # Create main LangSmith trace for location ping
+    main_run_id = tracer.create_run(
+        name="Location_Ping_Processing",
+        inputs={
+            "lat": fix.lat,
+            "lon": fix.lon,
+            "speed_mph": fix.speed,
+            "accuracy_m": fix.accuracy,
+            "home_id": home_id,
+            "device_id": device_id,
+            "endpoint": endpoint
+        },
+        run_type="chain"
+    )
+    
+    loc = (fix.lat, fix.lon)
+    speed_mph = fix.speed
+    
+    # Filter and record location, then determine distance, zone and movement trend
+    state = device_store.get(home_id, device_id)
+    obs = record_location(state, loc, speed_mph, fix.accuracy)
+    dist = obs.distance_miles
+    movement_trend = obs.movement_trend
+    
+    logger.info(f"📍 Location update [{home_id}/{device_id}]: {dist:.2f} miles, {movement_trend}, {speed_mph} mph")
+    
+    # Run the REAL Agent with REAL LLM
+    agent_result = runner.run(agent, obs, parent_run_id=main_run_id, state=state)
+    
+    response = {
+        "status": "ok",
+        "home_id": home_id,
+        "device_id": device_id,
+        **obs.to_dict(),
+        "agent_used": True,
+        "real_llm_used": agent_result.decided_by == "llm",
+        "decided_by": agent_result.decided_by,
+        "langsmith_enabled": LANGSMITH_ENABLED,
+        "circuit_breakers": breaker_states(),
+        "agent_result": agent_result.to_dict()
+    }
+    
+    # Update main trace with final results
+    tracer.update_run(main_run_id, 
+        outputs=response,
+        metadata={
+            "home_coordinates": home_coords,
+            "distance_miles": dist,
+            "movement_trend": movement_trend,
+            "agent_action": agent_result.action or "unknown",
+            "decided_by": agent_result.decided_by,
+            "total_location_history": obs.history_samples
+        }
+    )
+    
+    return response
+
+# Ping coalescing
+class PingBatch:
+    """One pending evaluation for a device; later pings overwrite the fix and share the result."""
+    
+    def __init__(self, payload, process=None):
+        self.payload = payload
+        self.process = process
+        self.pings = 1
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class PingCoalescer:
+    """Per-device throttle for bursty pings.
+    
+    The first ping for a device is evaluated immediately. Pings arriving while it runs, or within
+    COALESCE_WINDOW_MS of its start, collapse into a single trailing evaluation of the latest fix.
+    Repeats of the fix being (or just) evaluated share that result instead. The trailing
+    evaluation is started by a timer once the running one finishes and the window has closed,
+    so no thread waits on a device and one slow device never delays another's.
+    """
+    
+    def __init__(self, window=COALESCE_WINDOW_MS / 1000, ack=COALESCE_ACK):
+        self.window = window
+        self.ack = ack
+        self.slots = {}  # key -> {"current", "next", "last", "last_start"}
+        self.lock = threading.Lock()
+        self.stats = {"evaluations": 0, "coalesced": 0, "accepted": 0}
+    
+    def submit(self, key, payload, process, ack=None):
+        """Return (response, status) where status is "evaluated", "coalesced" or "accepted"."""
+        if self.window <= 0:
+            return process(payload), "evaluated"
+        ack = self.ack if ack is None else ack
+        now = time.time()
+        
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                if len(self.slots) >= 1024:
+                    self._prune(now)
+                slot = self.slots[key] = {"current": None, "next": None, "last": None, "last_start": 0}
+            current, pending, last = slot["current"], slot["next"], slot["last"]
+            
+            if current is None and pending is None and now - slot["last_start"] >= self.window:
+                # Leading edge: evaluate right away
+                batch = slot["current"] = PingBatch(payload)
+                slot["last_start"] = now
+                role = "run"
+            elif pending is None and current is not None and self._same_fix(current.payload, payload):
+                batch, role = current, "share"
+            elif pending is None and current is None and last is not None and self._same_fix(last.payload, payload):
+                batch, role = last, "share"
+            elif pending is None:
+                batch = slot["next"] = PingBatch(payload, process)
+                role = "run_next"
+                if current is None:
+                    self._schedule(slot)
+            else:
+                batch, role = pending, "share"
+                batch.payload = payload  # Latest fix wins
+            
+            if role == "share":
+                batch.pings += 1
+                self.stats["coalesced"] += 1
+        
+        if role == "run":
+            self._run(slot, batch, process)
+        
+        if role != "run" and ack:
+            with self.lock:
+                self.stats["accepted"] += 1
+            return {"status": "accepted", "coalesced": role == "share"}, "accepted"
+        
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        if role == "share" or batch.pings > 1:
+            return {**batch.result, "coalesced": True, "coalesced_pings": batch.pings}, "coalesced"
+        return batch.result, "evaluated"
+    
+    def _schedule(self, slot):
+        # Called with the lock held once nothing is running; the window stays open so more fixes can merge
+        delay = max(slot["last_start"] + self.window - time.time(), 0)
+        timer = threading.Timer(delay, self._run_next, (slot,))
+        timer.daemon = True
+        timer.start()
+    
+    def _run_next(self, slot):
+        with self.lock:
+            batch = slot["next"]
+            slot["next"] = None
+            slot["current"] = batch
+            slot["last_start"] = time.time()
+        self._run(slot, batch, batch.process)
+    
+    def _run(self, slot, batch, process):
+        try:
+            batch.result = process(batch.payload)
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self.lock:
+                slot["current"] = None
+                slot["last"] = batch if batch.error is None else None
+                self.stats["evaluations"] += 1
+                if slot["next"] is not None:
+                    self._schedule(slot)
+            batch.done.set()
+    
+    def _prune(self, now):
+        for key, slot in list(self.slots.items()):
+            if slot["current"] is None and slot["next"] is None and now - slot["last_start"] >= self.window:
+                del self.slots[key]
+    
+    @staticmethod
+    def _same_fix(a, b):
+        return a.get("lat") == b.get("lat") and a.get("lon") == b.get("lon")
+    
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "window_ms": self.window * 1000}
+
+ping_coalescer = PingCoalescer()
+
+# Home Assistant WebSocket ingest
+class WebSocket:
+    """Minimal RFC 6455 client: text messages, ping/pong and close; enough for Home Assistant's API.
+    
+    Frames are parsed from an internal buffer, so a socket timeout mid-frame loses nothing and
+    recv() can simply be called again.
+    """
+    
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    
+    def __init__(self, url, timeout=10):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("ws", "wss"):
+            raise ValueError(f"Not a WebSocket URL: {url}")
+        port = parsed.port or (443 if parsed.scheme == "wss" else 80)
+        sock = socket.create_connection((parsed.hostname, port), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Small frames go out immediately
+        if parsed.scheme == "wss":
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parsed.hostname)
+        self.sock = sock
+        self.buffer = bytearray()
+        self.fragments = []
+        
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+        sock.sendall((f"GET {path} HTTP/1.1\r\nHost: {parsed.netloc}\r\nUpgrade: websocket\r\n"
+                      f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+        while b"\r\n\r\n" not in self.buffer:
+            data = sock.recv(4096)
+            if not data:
+                raise ConnectionError("Connection closed during WebSocket handshake")
+            self.buffer += data
+        head, _, rest = bytes(self.buffer).partition(b"\r\n\r\n")
+        self.buffer = bytearray(rest)
+        lines = head.decode("latin-1").split("\r\n")
+        headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(":") for line in lines[1:])}
+        expected = base64.b64encode(hashlib.sha1((key + self.GUID).encode()).digest()).decode()
+        if lines[0].split()[1:2] != ["101"] or headers.get("sec-websocket-accept") != expected:
+            sock.close()
+            raise ConnectionError(f"WebSocket handshake refused: {lines[0]}")
+    
+    def settimeout(self, seconds):
+        self.sock.settimeout(seconds)
+    
+    def send(self, text):
+        self._send_frame(0x1, text.encode("utf-8"))
+    
+    def _send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, length)
+        mask = os.urandom(4)
+        self.sock.sendall(header + mask + self._mask(payload, mask))
+    
+    @staticmethod
+    def _mask(payload, mask):
+        if not payload:
+            return payload
+        repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+        return (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(len(payload), "big")
+    
+    def recv(self):
+        """Next text message; raises socket.timeout when idle and ConnectionError once closed."""
+        while True:
+            frame = self._parse_frame()
+            if frame is None:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionError("WebSocket connection closed")
+                self.buffer += data
+                continue
+            fin, opcode, payload = frame
+            if opcode == 0x9:
+                self._send_frame(0xA, payload)
+            elif opcode == 0x8:
+                try:
+                    self._send_frame(0x8, payload[:2])
+                except OSError:
+                    pass
+                raise ConnectionError("WebSocket closed by server")
+            elif opcode in (0x0, 0x1, 0x2):
+                self.fragments.append(payload)
+                if fin:
+                    message, self.fragments = b"".join(self.fragments), []
+                    return message.decode("utf-8")
+    
+    def _parse_frame(self):
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return None
+        fin, opcode = buffer[0] & 0x80, buffer[0] & 0x0F
+        masked, length = buffer[1] & 0x80, buffer[1] & 0x7F
+        offset = 2
+        if length == 126:
+            if len(buffer) < 4:
+                return None
+            length, offset = struct.unpack_from("!H", buffer, 2)[0], 4
+        elif length == 127:
+            if len(buffer) < 10:
+                return None
+            length, offset = struct.unpack_from("!Q", buffer, 2)[0], 10
+        mask = None
+        if masked:
+            mask, offset = bytes(buffer[offset:offset + 4]), offset + 4
+        if len(buffer) < offset + length:
+            return None
+        payload = bytes(buffer[offset:offset + length])
+        del buffer[:offset + length]
+        return bool(fin), opcode, self._mask(payload, mask) if mask else payload
+    
+    def close(self):
+        try:
+            self._send_frame(0x8, struct.pack("!H", 1000))
+        except OSError:
+            pass
+        self.sock.close()
+
+class HomeAssistantStream:
+    """Persistent Home Assistant WebSocket subscription feeding device_tracker moves into the ping pipeline.
+    
+    Authenticates, subscribes to state_changed and turns each configured tracker's position change
+    into a /ping-shaped payload, handed to ping_coalescer/process_ping on a worker pool so a slow
+    decision never stalls the stream. The pool has a thread per tracker: a busy tracker's later
+    updates are coalesced and acknowledged at once, so it holds at most one thread and never
+    delays another tracker's. A dropped connection (or a missed heartbeat pong) reconnects
+    with jittered exponential backoff and subscribes again.
+    """
+    
+    MPS_TO_MPH = 2.23694  # The companion app reports speed in m/s
+    
+    def __init__(self, url=HA_WEBSOCKET_URL, token=HA_TOKEN, trackers=HA_DEVICE_TRACKERS, home_id=HA_HOME_ID,
+                 ping_interval=HA_PING_INTERVAL, reconnect_max=HA_RECONNECT_MAX_SECONDS):
+        self.url = url
+        self.token = token
+        self.home_id = home_id
+        self.ping_interval = ping_interval
+        self.reconnect_max = reconnect_max
+        self.entities = {}  # entity_id -> device_id
+        for item in trackers.split(","):
+            entity_id, _, device_id = item.strip().partition("=")
+            if entity_id:
+                self.entities[entity_id] = device_id or entity_id.split(".", 1)[-1]
+        # One thread per tracker; see the class docstring
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.entities), 1), thread_name_prefix="ha-ingest")
+        self.ws = None
+        self.connected = False  # Authenticated and subscribed
+        self.thread = None
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {"connects": 0, "disconnects": 0, "auth_failures": 0, "events": 0, "pings": 0,
+                      "ignored": 0, "errors": 0}
+        self.last_event = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="ha-websocket", daemon=True)
+        self.thread.start()
+    
+    def close(self):
+        self.closed.set()
+        ws = self.ws
+        if ws is not None:
+            ws.close()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.executor.shutdown(wait=False)
+    
+    def _run(self):
+        delay = 1.0
+        while not self.closed.is_set():
+            try:
+                self.ws = WebSocket(self.url)
+                self._session(self.ws)
+            except (OSError, ValueError) as e:
+                if not self.closed.is_set():
+                    logger.warning(f"⚠️ Home Assistant WebSocket: {e}")
+            finally:
+                if self.ws is not None:
+                    self.ws.close()
+                    self.ws = None
+                if self.connected:
+                    delay = 1.0  # The last session got as far as subscribing, so start backoff over
+                    self.connected = False
+            if self.closed.is_set():
+                return
+            with self.lock:
+                self.stats["disconnects"] += 1
+            self.closed.wait(random.uniform(0.5, 1.0) * delay)
+            delay = min(delay * 2, self.reconnect_max)
+    
+    def _session(self, ws):
+        """Authenticate, subscribe and read events until the connection drops or the stream is closed."""
+        ws.settimeout(10)
+        message = json_loads(ws.recv())
+        if message.get("type") == "auth_required":
+            ws.send(json.dumps({"type": "auth", "access_token": self.token}))
+            message = json_loads(ws.recv())
+        if message.get("type") != "auth_ok":
+            with self.lock:
+                self.stats["auth_failures"] += 1
+            raise ConnectionError(f"authentication failed: {message.get('message', message.get('type'))}")
+        
+        ws.send(json.dumps({"id": 1, "type": "subscribe_events", "event_type": "state_changed"}))
+        self.connected = True
+        with self.lock:
+            self.stats["connects"] += 1
+        logger.info(f"🏠 Subscribed to Home Assistant state changes for {sorted(self.entities)}")
+        
+        next_id = 2
+        awaiting_pong = False
+        ws.settimeout(self.ping_interval)
+        while not self.closed.is_set():
+            try:
+                message = json_loads(ws.recv())
+            except socket.timeout:
+                if awaiting_pong:
+                    raise ConnectionError("no heartbeat pong from Home Assistant")
+                ws.send(json.dumps({"id": next_id, "type": "ping"}))
+                next_id += 1
+                awaiting_pong = True
+                continue
+            awaiting_pong = False
+            kind = message.get("type")
+            if kind == "event":
+                self._handle_event(message.get("event") or {})
+            elif kind == "result" and not message.get("success"):
+                raise ConnectionError(f"subscription failed: {message.get('error')}")
+    
+    def _handle_event(self, event):
+        data = event.get("data") or {}
+        device_id = self.entities.get(data.get("entity_id"))
+        if device_id is None:
+            return
+        with self.lock:
+            self.stats["events"] += 1
+            self.last_event = time.time()
+        new = (data.get("new_state") or {}).get("attributes") or {}
+        old = (data.get("old_state") or {}).get("attributes") or {}
+        lat, lon = new.get("latitude"), new.get("longitude")
+        if lat is None or lon is None or (lat == old.get("latitude") and lon == old.get("longitude")):
+            # Attribute-only updates (battery, state name) don't move the device
+            with self.lock:
+                self.stats["ignored"] += 1
+            return
+        payload = {
+            "lat": lat,
+            "lon": lon,
+            "speed_mph": (new.get("speed") or 0) * self.MPS_TO_MPH,
+            "accuracy_m": new.get("gps_accuracy"),
+            "home_id": self.home_id,
+            "device_id": device_id,
+        }
+        self.executor.submit(self._process, payload)
+    
+    def _process(self, payload):
+        try:
+            with metrics.timer("ac_agent_request_seconds", endpoint="ha_websocket"):
+                ping_coalescer.submit((payload["home_id"], payload["device_id"]), payload,
+                                      lambda p: process_ping(p, endpoint="ha_websocket"), ack=True)
+            with self.lock:
+                self.stats["pings"] += 1
+        except Exception as e:
+            metrics.inc("ac_agent_errors_total", service="ha_websocket")
+            with self.lock:
+                self.stats["errors"] += 1
+            logger.error(f"❌ Error processing Home Assistant update for {payload['device_id']}: {e}")
+    
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "connected": self.connected,
+                    "entities": sorted(self.entities),
+                    "last_event_age_seconds": time.time() - self.last_event if self.last_event else None}
+
+ha_stream = HomeAssistantStream() if HA_WEBSOCKET_URL else None
+
+# On-demand profiling
+class RequestProfiler:
+    """Profiles the next N hot-path requests when armed through /debug/profile.
+    
+    "cprofile" runs each selected request under its own cProfile.Profile (profiling hooks are
+    per-thread) and merges them into one pstats result. "sample" starts a thread that records the
+    wall-clock stack of every thread serving a selected request (or of every thread) each
+    interval, as collapsed stacks for flame graphs. Unarmed, a request pays for one attribute check.
+    """
+    
+    MODES = ("cprofile", "sample")
+    DEFAULT_PATHS = ("/ping", "/ping/batch", "/test")
+    
+    def __init__(self):
+        self.armed = False
+        self.lock = threading.Lock()
+        self.mode = None
+        self.paths = self.DEFAULT_PATHS
+        self.remaining = 0
+        self.active = set()  # Thread idents inside a selected request
+        self.profiles = []
+        self.stacks = {}
+        self.samples = 0
+        self.requests = 0
+        self.sampler = None
+        self.stop_sampling = threading.Event()
+        self.tracemalloc_baseline = None
+    
+    def arm(self, mode="cprofile", requests=20, paths=None, interval_ms=5, all_threads=False):
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of {self.MODES}")
+        if requests < 1:
+            raise ValueError("requests must be at least 1")
+        self._stop_sampler()
+        with self.lock:
+            self.mode = mode
+            self.paths = tuple(paths) if paths else self.DEFAULT_PATHS
+            self.remaining = requests
+            self.interval = max(interval_ms, 1) / 1000
+            self.all_threads = all_threads
+            self.profiles, self.stacks, self.samples, self.requests = [], {}, 0, 0
+            self.armed = True
+        if mode == "sample":
+            self.stop_sampling.clear()
+            self.sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+            self.sampler.start()
+        logger.info(f"🔬 Profiling the next {requests} requests to {list(self.paths)} ({mode})")
+    
+    def run(self, handler):
+        """Run a request handler, profiled if a slot is left."""
+        with self.lock:
+            if self.remaining <= 0:
+                selected = False
+            else:
+                selected = True
+                self.remaining -= 1
+                self.active.add(threading.get_ident())
+        if not selected:
+            return handler()
+        try:
+            if self.mode == "cprofile":
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(handler)
+                finally:
+                    with self.lock:
+                        self.profiles.append(profile)
+            return handler()
+        finally:
+            with self.lock:
+                self.active.discard(threading.get_ident())
+                self.requests += 1
+                finished = self.remaining <= 0 and not self.active
+                if finished:
+                    self.armed = False
+            if finished:
+                self.stop_sampling.set()
+                logger.info(f"🔬 Profile complete: {self.requests} requests")
+    
+    def _sample(self):
+        me = threading.get_ident()
+        names = {}
+        while not self.stop_sampling.wait(self.interval):
+            with self.lock:
+                targets = None if self.all_threads else set(self.active)
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (targets is not None and ident not in targets):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                with self.lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                    self.samples += 1
+    
+    def _stop_sampler(self):
+        self.stop_sampling.set()
+        if self.sampler is not None:
+            self.sampler.join(timeout=5)
+            self.sampler = None
+    
+    def cancel(self):
+        with self.lock:
+            self.remaining = 0
+            self.armed = False
+        self._stop_sampler()
+    
+    def status(self):
+        with self.lock:
+            return {"armed": self.armed, "mode": self.mode, "paths": list(self.paths), "remaining": self.remaining,
+                    "profiled_requests": self.requests, "samples": self.samples,
+                    "tracemalloc": tracemalloc.is_tracing()}
+    
+    def result(self, fmt=None):
+        """(content type, filename, body) of the last profile: pstats (or its text) or collapsed stacks."""
+        with self.lock:
+            mode, profiles, stacks = self.mode, list(self.profiles), dict(self.stacks)
+        if mode == "sample":
+            body = "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+            return "text/plain", "ac_agent.collapsed", body.encode()
+        if not profiles:
+            raise LookupError("No profiled requests yet")
+        stream = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=stream)
+        if fmt == "text":
+            stats.sort_stats("cumulative").print_stats(80)
+            return "text/plain", "ac_agent_pstats.txt", stream.getvalue().encode()
+        # The same bytes Stats.dump_stats() writes; load with pstats, snakeviz or gprof2dot
+        return "application/octet-stream", "ac_agent.pstats", marshal.dumps(stats.stats)
+    
+    def tracemalloc_action(self, action, frames=25, top=30):
+        """Start, snapshot (with a diff against the previous snapshot) or stop allocation tracing."""
+        if action == "start":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.tracemalloc_baseline = tracemalloc.take_snapshot()
+            return f"tracemalloc started ({frames} frames); baseline snapshot taken\n"
+        if action == "stop":
+            tracemalloc.stop()
+            self.tracemalloc_baseline = None
+            return "tracemalloc stopped\n"
+        if action != "snapshot":
+            raise ValueError("action must be start, snapshot or stop")
+        if not tracemalloc.is_tracing():
+            raise LookupError("tracemalloc is not running; start it first")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Traced memory: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB", ""]
+        baseline, self.tracemalloc_baseline = self.tracemalloc_baseline, snapshot
+        if baseline is not None:
+            lines.append(f"Top {top} changes since the previous snapshot:")
+            lines.extend(str(stat) for stat in snapshot.compare_to(baseline, "lineno")[:top])
+            lines.append("")
+        lines.append(f"Top {top} allocation sites:")
+        lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:top])
+        return "\n".join(lines) + "\n"
+
+profiler = RequestProfiler()
+
+# Live event stream
+class EventSubscriber:
+    """One /events connection: its filters and a bounded buffer of encoded events."""
+    
+    def __init__(self, sock, kinds=None, home_id=None, buffer=EVENTS_BUFFER):
+        self.sock = sock
+        self.kinds = kinds  # None = every event type
+        self.home_id = home_id  # None = every home; events without a home always pass
+        self.queue = deque(maxlen=buffer)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0  # Since the last write; reported to the client as a "dropped" event
+        self.stats = {"sent": 0, "dropped": 0}
+    
+    def wants(self, kind, home_id):
+        return ((self.kinds is None or kind in self.kinds)
+                and (self.home_id is None or home_id is None or home_id == self.home_id))
+
+class EventBroadcaster:
+    """Fans out observations, decisions, actuation results and state changes to /events subscribers.
+    
+    publish() encodes an event once and appends it to each interested subscriber's bounded buffer;
+    it never touches a socket, so a slow dashboard costs the ping path nothing more than that. Each
+    subscriber has its own writer thread; when its buffer is full the oldest event is dropped and
+    the client is told how many it missed. With no subscribers, publish() returns immediately.
+    """
+    
+    def __init__(self, max_subscribers=EVENTS_MAX_SUBSCRIBERS, buffer=EVENTS_BUFFER,
+                 keepalive=EVENTS_KEEPALIVE_SECONDS):
+        self.max_subscribers = max_subscribers
+        self.buffer = buffer
+        self.keepalive = keepalive
+        self.subscribers = ()  # Replaced rather than mutated, so publish() reads it without a lock
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(1)
+        self.stats = {"subscribed": 0, "rejected": 0}
+    
+    def publish(self, kind, **data):
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        home_id = data.get("home_id")
+        message = None
+        for subscriber in subscribers:
+            if not subscriber.wants(kind, home_id):
+                continue
+            if message is None:
+                body = json_dumps({"type": kind, "time": time.time(), **data})
+                message = f"id: {next(self.sequence)}\nevent: {kind}\ndata: ".encode() + body + b"\n\n"
+                metrics.inc("ac_agent_events_total", type=kind)
+            with subscriber.cond:
+                if len(subscriber.queue) == subscriber.queue.maxlen:
+                    subscriber.dropped += 1
+                    subscriber.stats["dropped"] += 1
+                subscriber.queue.append(message)
+                subscriber.cond.notify()
+    
+    def subscribe(self, sock, kinds=None, home_id=None):
+        """Register a subscriber, or return None when EVENTS_MAX_SUBSCRIBERS are connected."""
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                self.stats["rejected"] += 1
+                return None
+            subscriber = EventSubscriber(sock, kinds, home_id, self.buffer)
+            self.subscribers += (subscriber,)
+            self.stats["subscribed"] += 1
+        return subscriber
+    
+    def start(self, subscriber, snapshot=None):
+        """Stream to a subscriber whose response headers have been sent, starting with a state snapshot."""
+        if snapshot is not None:
+            body = json_dumps({"type": "snapshot", "time": time.time(), **snapshot})
+            with subscriber.cond:
+                subscriber.queue.appendleft(b"event: snapshot\ndata: " + body + b"\n\n")
+        # A small kernel send buffer keeps a stalled client's backlog bounded, so its writes time out
+        subscriber.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+        subscriber.sock.settimeout(self.keepalive)
+        threading.Thread(target=self._stream, args=(subscriber,), name="events-writer", daemon=True).start()
+    
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers = tuple(s for s in self.subscribers if s is not subscriber)
+        with subscriber.cond:
+            subscriber.closed = True
+            subscriber.cond.notify()
+    
+    def _stream(self, subscriber):
+        try:
+            while True:
+                with subscriber.cond:
+                    if not subscriber.queue and not subscriber.closed:
+                        subscriber.cond.wait(self.keepalive)
+                    if subscriber.closed:
+                        return
+                    batch = list(subscriber.queue)
+                    subscriber.queue.clear()
+                    dropped, subscriber.dropped = subscriber.dropped, 0
+                if dropped:
+                    batch.insert(0, b"event: dropped\ndata: " + json_dumps({"type": "dropped", "count": dropped})
+                                 + b"\n\n")
+                subscriber.sock.sendall(b"".join(batch) if batch else b": keepalive\n\n")
+                subscriber.stats["sent"] += len(batch)
+        except OSError:
+            pass  # Client went away or stopped reading for a whole keepalive interval
+        finally:
+            self.unsubscribe(subscriber)
+            try:
+                subscriber.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            subscriber.sock.close()
+    
+    def close(self):
+        for subscriber in self.subscribers:
+            self.unsubscribe(subscriber)
+    
+    def get_stats(self):
+        subscribers = self.subscribers
+        return {**self.stats, "subscribers": len(subscribers), "max_subscribers": self.max_subscribers,
+                "buffer": self.buffer, "queued": sum(len(s.queue) for s in subscribers),
+                "dropped": sum(s.stats["dropped"] for s in subscribers)}
+
+events = EventBroadcaster()
+
 # HTTP Server
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
+class AgentHTTPServer(HTTPServer):
+    """HTTPServer whose handlers can take over their connection (the /events streams)."""
+    
+    def __init__(self, server_address, handler_class):
+        super().__init__(server_address, handler_class)
+        self.detached = set()
+        self.detached_lock = threading.Lock()
+    
+    def detach(self, request):
+        """Leave a connection open after its handler returns; the new owner closes it."""
+        with self.detached_lock:
+            self.detached.add(request)
+    
+    def shutdown_request(self, request):
+        with self.detached_lock:
+            if request in self.detached:
+                self.detached.discard(request)
+                return
+        super().shutdown_request(request)
+
+class WorkerPoolHTTPServer(AgentHTTPServer):
+    """HTTPServer that hands each connection to a bounded pool of worker threads.
+    
+    At most queue_size connections wait for a worker; past that, new ones get an immediate 503
+    rather than a growing backlog that is answered long after the client gave up.
+    """
+    
+    OVERLOADED_BODY = b'{"status": "error", "error": "server overloaded"}'
+    OVERLOADED = (b"HTTP/1.0 503 Service Unavailable\r\nContent-Type: application/json\r\nRetry-After: 1\r\n"
+                  b"Connection: close\r\nContent-Length: %d\r\n\r\n" % len(OVERLOADED_BODY)) + OVERLOADED_BODY
+    
+    def __init__(self, server_address, handler_class, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE):
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ac-worker")
+    
+    def process_request(self, request, client_address):
+        with self.lock:
+            full = self.queued >= self.queue_size
+            if not full:
+                self.queued += 1
+        if full:
+            metrics.inc("ac_agent_shed_total", service="server", reason="queue_full")
+            try:
+                request.setblocking(False)  # A fresh socket's send buffer takes this; never block accept
+                request.send(self.OVERLOADED)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.executor.submit(self.process_request_worker, request, client_address)
+    
+    def process_request_worker(self, request, client_address):
+        with self.lock:
+            self.queued -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+    
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
 class ACAgentHandler(BaseHTTPRequestHandler):
+    ENDPOINTS = ("/ping", "/ping/batch", "/test", "/health", "/metrics", "/events")
+    timeout = SERVER_REQUEST_TIMEOUT  # An idle or slow client can't hold a worker longer than this
+    
+    def do_GET(self):
+        with metrics.timer("ac_agent_request_seconds", endpoint=self.path if self.path in self.ENDPOINTS else "other"):
+            if profiler.armed and self.path in profiler.paths:
+                profiler.run(self.handle_get)
+            else:
+                self.handle_get()
+    
     def do_POST(self):
-        if self.path == "/ping":
+        with metrics.timer("ac_agent_request_seconds", endpoint=self.path if self.path in self.ENDPOINTS else "other"):
+            if profiler.armed and self.path in profiler.paths:
+                profiler.run(self.handle_post)
+            else:
+                self.handle_post()
+    
+    def send_json_error(self, code, message):
+        body = json_dumps({"status": "error", "error": message})
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def handle_debug(self):
+        """/debug/profile and /debug/tracemalloc, for callers presenting DEBUG_TOKEN."""
+        url = urlparse(self.path)
+        supplied = (self.headers.get("X-Debug-Token")
+                    or self.headers.get("Authorization", "").removeprefix("Bearer ")).strip()
+        if not DEBUG_TOKEN or not hmac.compare_digest(supplied.encode(), DEBUG_TOKEN.encode()):
+            self.send_error(404, "Not Found")
+            return
+        try:
+            body = {}
+            if self.command == "POST" and int(self.headers.get("Content-Length") or 0):
+                body = json_loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if not isinstance(body, dict):
+                    raise ValueError(f"Expected a JSON object, got {type(body).__name__}")
+            if url.path == "/debug/profile" and self.command == "POST":
+                if body.get("cancel"):
+                    profiler.cancel()
+                else:
+                    profiler.arm(body.get("mode", "cprofile"), int(body.get("requests", 20)), body.get("paths"),
+                                 float(body.get("interval_ms", 5)), bool(body.get("all_threads", False)))
+                content_type, filename, data = "application/json", None, json_dumps(profiler.status())
+            elif url.path == "/debug/profile" and self.command == "GET":
+                content_type, filename, data = "application/json", None, json_dumps(profiler.status())
+            elif url.path == "/debug/profile/result" and self.command == "GET":
+                fmt = dict(part.partition("=")[::2] for part in url.query.split("&") if part).get("format")
+                content_type, filename, data = profiler.result(fmt)
+            elif url.path == "/debug/tracemalloc" and self.command == "POST":
+                text = profiler.tracemalloc_action(body.get("action", "snapshot"), int(body.get("frames", 25)),
+                                                   int(body.get("top", 30)))
+                content_type, filename, data = "text/plain", None, text.encode()
+            else:
+                self.send_error(404, "Not Found")
+                return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except LookupError as e:
+            self.send_error(409, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if filename:
+            self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def handle_events(self):
+        """Stream events as server-sent events; ?types=decision,actuation and ?home_id= narrow them."""
+        query = parse_qs(urlparse(self.path).query)
+        kinds = {kind for value in query.get("types", []) for kind in value.split(",") if kind} or None
+        subscriber = events.subscribe(self.connection, kinds, query.get("home_id", [None])[0])
+        if subscriber is None:
+            self.send_error(503, "Too many event subscribers")
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.flush()
+        except OSError:
+            events.unsubscribe(subscriber)
+            return
+        # Hand the connection to the subscriber's writer thread and free this worker
+        self.server.detach(self.connection)
+        self.close_connection = True
+        events.start(subscriber, snapshot={
+            "circuit_breakers": breaker_states(),
+            "decision_cache": runner.cache.get_stats() if runner.cache else None,
+            "actuation_queue": actuation_queue.get_stats(),
+        })
+    
+    def handle_get(self):
+        if self.path.startswith("/debug/"):
+            self.handle_debug()
+        elif self.path == "/events" or self.path.startswith("/events?"):
+            self.handle_events()
+        elif self.path == "/metrics":
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/health":
+            response = {
+                "status": "ok",
+                "decision_mode": runner.mode,
+                "circuit_breakers": breaker_states(),
+                "llm_hedging": llm_caller.get_stats(),
+                "decision_cache": runner.cache.get_stats() if runner.cache else None,
+                "learned_policy": runner.learned.get_stats() if runner.learned else None,
+                "device_store": device_store.get_stats(),
+                "zone_index": zone_index.get_stats(),
+                "state_journal": state_journal.get_stats(),
+                "ping_coalescer": ping_coalescer.get_stats(),
+                "home_assistant": ha_stream.get_stats() if ha_stream else None,
+                "actuation_queue": actuation_queue.get_stats(),
+                "events": events.get_stats(),
+                "trace_exporter": tracer.exporter.get_stats(),
+                "http_clients": {name: client.get_stats() for name, client in http_clients.items()}
+            }
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json_dumps(response))
+        else:
+            self.send_error(404, "Not Found")
+    
+    def handle_post(self):
+        if self.path.startswith("/debug/"):
+            self.handle_debug()
+        elif self.path == "/ping":
             try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                payload = json.loads(post_data.decode('utf-8'))
+                with metrics.timer("ac_agent_stage_seconds", stage="parse"):
+                    content_length = int(self.headers['Content-Length'])
+                    post_data = self.rfile.read(content_length)
+                    payload = json_loads(post_data)
                 
-                # Create main LangSmith trace for location ping
-                main_run_id = tracer.create_run(
-                    name="Location_Ping_Processing",
-                    inputs={
-                        "lat": payload["lat"],
-                        "lon": payload["lon"],
-                        "speed_mph": payload.get("speed_mph", 0),
-                        "endpoint": "/ping"
-                    },
-                    run_type="chain"
-                )
-                
-                loc = (payload["lat"], payload["lon"])
-                speed_mph = payload.get("speed_mph", 0)
-                dist = haversine(loc, HOME)
+                # Validate here too, so a coalesced or acknowledged ping still gets its 400
+                Fix.from_dict(payload, time.time())
+                key = (str(payload.get("home_id", DEFAULT_HOME_ID)), str(payload.get("device_id", DEFAULT_DEVICE_ID)))
+                response, status = ping_coalescer.submit(key, payload, process_ping, ack=payload.get("ack"))
                 
-                # Clean up old location history
-                cleanup_old_locations()
+                self.send_response(202 if status == "accepted" else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json_dumps(response))
                 
-                # Add current location to history
-                location_entry = {
-                    "timestamp": time.time(),
-                    "distance": dist,
-                    "speed": speed_mph,
-                    "lat": loc[0],
-                    "lon": loc[1]
-                }
-                location_history.append(location_entry)
+            except ValueError as e:
+                self.send_json_error(400, str(e))
+            except Exception as e:
+                metrics.inc("ac_agent_errors_total", service="http")
+                logger.error(f"❌ Error processing request: {e}")
+                self.send_error(500, str(e))
                 
-                # Determine movement trend
-                movement_trend = determine_movement_trend()
+        elif self.path == "/ping/batch":
+            try:
+                with metrics.timer("ac_agent_stage_seconds", stage="parse"):
+                    content_length = int(self.headers['Content-Length'])
+                    post_data = self.rfile.read(content_length)
+                    payload = json_loads(post_data)
                 
-                obs = {
-                    "distance_miles": dist, 
-                    "speed_mph": speed_mph,
-                    "movement_trend": movement_trend,
-                    "history_samples": len(location_history)
-                }
+                if not isinstance(payload, dict):
+                    raise ValueError(f"Expected a JSON object, got {type(payload).__name__}")
+                home_id = str(payload.get("home_id", DEFAULT_HOME_ID))
+                device_id = str(payload.get("device_id", DEFAULT_DEVICE_ID))
+                home = HOMES.get(home_id)
+                fixes = payload.get("fixes")
+                if home is None:
+                    raise ValueError(f"Unknown home_id: {home_id}")
+                if not isinstance(fixes, list) or not fixes:
+                    raise ValueError("Expected a non-empty 'fixes' array")
+                now = time.time()
+                fixes = [Fix.from_dict(fix, now) for fix in fixes]
+                home_coords = (home["lat"], home["lon"])
                 
-                logger.info(f"📍 Location update: {dist:.2f} miles, {movement_trend}, {speed_mph} mph")
+                # Create main LangSmith trace for the replayed batch
+                main_run_id = tracer.create_run(
+                    name="Location_Batch_Processing",
+                    inputs={
+                        "fixes": len(fixes),
+                        "home_id": home_id,
+                        "device_id": device_id,
+                        "endpoint": "/ping/batch"
+                    },
+                    run_type="chain"
+                )
                 
-                # Run the REAL Agent with REAL LLM
-                agent_result = runner.run(agent, obs, parent_run_id=main_run_id)
+                # Merge every fix into history, then decide once on the final state
+                state = device_store.get(home_id, device_id)
+                obs, merged = record_locations(state, fixes, home_coords)
                 
-                response = {
-                    "status": "ok",
-                    **obs,
-                    "agent_used": True,
-                    "real_llm_used": True,
-                    "langsmith_enabled": LANGSMITH_ENABLED,
-                    "agent_result": agent_result
-                }
+                if obs is None:
+                    agent_result = Decision("no_action", "no_action", reason="all fixes outside retention window")
+                    response = {"status": "ok", "home_id": home_id, "device_id": device_id,
+                                "fixes_received": len(fixes), "fixes_merged": 0, "agent_result": agent_result.to_dict()}
+                else:
+                    logger.info(f"📍 Batch update [{home_id}/{device_id}]: {merged}/{len(fixes)} fixes merged, "
+                                f"{obs.distance_miles:.2f} miles, {obs.movement_trend}")
+                    
+                    agent_result = runner.run(agent, obs, parent_run_id=main_run_id, state=state)
+                    
+                    response = {
+                        "status": "ok",
+                        "home_id": home_id,
+                        "device_id": device_id,
+                        "fixes_received": len(fixes),
+                        "fixes_merged": merged,
+                        **obs.to_dict(),
+                        "decided_by": agent_result.decided_by,
+                        "langsmith_enabled": LANGSMITH_ENABLED,
+                        "circuit_breakers": breaker_states(),
+                        "agent_result": agent_result.to_dict()
+                    }
                 
-                # Update main trace with final results
-                tracer.update_run(main_run_id, 
+                tracer.update_run(main_run_id,
                     outputs=response,
                     metadata={
-                        "home_coordinates": HOME,
-                        "distance_miles": dist,
-                        "movement_trend": movement_trend,
-                        "agent_action": agent_result.get("action", "unknown"),
-                        "total_location_history": len(location_history)
+                        "home_coordinates": home_coords,
+                        "fixes_merged": merged,
+                        "agent_action": agent_result.action or "unknown",
+                        "decided_by": agent_result.decided_by
                     }
                 )
                 
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/json')
                 self.end_headers()
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+                self.wfile.write(json_dumps(response))
                 
+            except ValueError as e:
+                self.send_json_error(400, str(e))
             except Exception as e:
-                logger.error(f"❌ Error processing request: {e}")
+                metrics.inc("ac_agent_errors_total", service="http")
+                logger.error(f"❌ Error processing batch: {e}")
                 self.send_error(500, str(e))
                 
         elif self.path == "/test":
@@ -563,45 +3733,29 @@ class ACAgentHandler(BaseHTTPRequestHandler):
                 
                 loc = (test_lat, test_lon)
                 speed_mph = test_speed
-                dist = haversine(loc, HOME)
-                
-                # Clean up old location history
-                cleanup_old_locations()
-                
-                # Add current location to history
-                location_entry = {
-                    "timestamp": time.time(),
-                    "distance": dist,
-                    "speed": speed_mph,
-                    "lat": loc[0],
-                    "lon": loc[1]
-                }
-                location_history.append(location_entry)
-                
-                # Determine movement trend
-                movement_trend = determine_movement_trend()
                 
-                obs = {
-                    "distance_miles": dist, 
-                    "speed_mph": speed_mph,
-                    "movement_trend": movement_trend,
-                    "history_samples": len(location_history)
-                }
+                # Record location and determine movement trend
+                state = device_store.get()
+                obs = record_location(state, loc, speed_mph)
+                dist = obs.distance_miles
+                movement_trend = obs.movement_trend
                 
                 logger.info(f"📍 Test location update: {dist:.2f} miles, {movement_trend}, {speed_mph} mph")
                 
                 # Run the REAL Agent with REAL LLM
-                agent_result = runner.run(agent, obs, parent_run_id=main_run_id)
+                agent_result = runner.run(agent, obs, parent_run_id=main_run_id, state=state)
                 
                 response = {
                     "status": "test_ok", 
                     "message": "Test endpoint processed with REAL LLM",
                     "simulated_location": {"lat": test_lat, "lon": test_lon},
-                    **obs,
+                    **obs.to_dict(),
                     "agent_used": True,
-                    "real_llm_used": True,
+                    "real_llm_used": agent_result.decided_by == "llm",
+                    "decided_by": agent_result.decided_by,
                     "langsmith_enabled": LANGSMITH_ENABLED,
-                    "agent_result": agent_result
+                    "circuit_breakers": breaker_states(),
+                    "agent_result": agent_result.to_dict()
                 }
                 
                 # Update main trace with test results
@@ -611,24 +3765,37 @@ class ACAgentHandler(BaseHTTPRequestHandler):
                         "test_coordinates": {"lat": test_lat, "lon": test_lon},
                         "simulated_distance": dist,
                         "simulated_movement": movement_trend,
-                        "agent_action": agent_result.get("action", "unknown")
+                        "agent_action": agent_result.action or "unknown",
+                        "decided_by": agent_result.decided_by
                     }
                 )
                 
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/json')
                 self.end_headers()
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+                self.wfile.write(json_dumps(response))
                 
             except Exception as e:
+                metrics.inc("ac_agent_errors_total", service="http")
                 logger.error(f"❌ Test error: {e}")
                 self.send_error(500, str(e))
         else:
             self.send_error(404, "Not Found")
 
+def create_server(address=('0.0.0.0', 8000), workers=SERVER_WORKERS):
+    """Create the HTTP server, pooled unless configured for a single worker."""
+    if workers <= 1:
+        return AgentHTTPServer(address, ACAgentHandler)
+    return WorkerPoolHTTPServer(address, ACAgentHandler, workers=workers)
+
+def handle_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
 def main():
     logger.info("🚀 Starting Smart AC Agent with REAL LLM and Agents SDK on Coral Dev Board")
     logger.info(f"🏠 Home location: {HOME}")
+    if len(HOMES) > 1:
+        logger.info(f"🏘️ Configured homes: {sorted(HOMES)}")
     logger.info(f"🔧 IFTTT key configured: {'Yes' if IFTTT_KEY else 'No'}")
     logger.info(f"🤖 OpenAI API key configured: {'Yes' if OPENAI_API_KEY else 'No'}")
     logger.info(f"📊 LangSmith monitoring: {'Enabled' if LANGSMITH_ENABLED else 'Disabled'}")
@@ -636,16 +3803,41 @@ def main():
         logger.info(f"📊 LangSmith project: {LANGSMITH_PROJECT}")
     logger.info(f"🤖 Using REAL Agent: {agent.name} with model {agent.model}")
     logger.info(f"🛠️ Agent tools: {[tool.name for tool in agent.tools]}")
+    logger.info(f"📏 Decision mode: {runner.mode}")
+    if runner.learned and runner.mode == "hybrid":
+        logger.info(f"🧠 Learned policy: {LEARNED_POLICY_PATH} (min confidence {runner.learned.min_confidence})")
+    elif runner.learned:
+        logger.warning(f"🧠 Learned policy {LEARNED_POLICY_PATH} is only used in hybrid mode; ignoring it")
+    
+    if STATE_DB_PATH:
+        state_journal.open()
+        state_journal.replay(device_store)
+        logger.info(f"💾 State journal: {STATE_DB_PATH}")
     
-    server = HTTPServer(('0.0.0.0', 8000), ACAgentHandler)
+    # Treat SIGTERM (docker stop) like Ctrl+C so queued traces and state are flushed
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
+    server = create_server()
     logger.info("🌐 Server running on http://0.0.0.0:8000")
-    logger.info("📡 Endpoints: /ping, /test")
+    logger.info(f"🧵 Worker threads: {max(SERVER_WORKERS, 1)}")
+    logger.info("📡 Endpoints: /ping, /ping/batch, /test, /health, /metrics, /events")
+    
+    if ha_stream is not None:
+        ha_stream.start()
+        logger.info(f"🏠 Home Assistant WebSocket ingest: {HA_WEBSOCKET_URL}")
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         logger.info("🛑 Server stopped")
-        server.shutdown()
+        server.server_close()
+        if ha_stream is not None:
+            ha_stream.close()
+        actuation_queue.close()
+        events.close()
+        llm_caller.close()
+        tracer.exporter.close()
+        state_journal.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Offline trace-replay simulator for tuning the Smart AC Agent's decision policy.
+
+Replays recorded location traces (JSONL or CSV) through the agent's own PositionFilter,
+haversine, TrendEstimator and idempotent decision logic - no HTTP, no LLM calls, no AC actuation -
+across a process pool, and reports actuations per trip, pre-cool lead time and flip-flops.
+
+Each record needs a trace/device id, a timestamp (epoch seconds or ISO 8601), lat and lon;
+speed_mph, accuracy_m, home_lat and home_lon are optional:
+
+    {"device_id": "alex", "timestamp": 1760000000, "lat": 40.75, "lon": -74.05, "speed_mph": 25}
+
+    python simulate.py traces.jsonl --policy rules --precool-radius 2.5
+    python simulate.py traces.csv --policy hybrid-cached --llm-cache llm_decisions.jsonl
+    python simulate.py traces.jsonl --policy stub:no_action
+"""
+import argparse
+import csv
+import importlib
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+os.environ.setdefault("STATE_DB_PATH", "")
+os.environ.setdefault("LANGSMITH_API_KEY", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main as agent_main
+
+agent_main.logger.setLevel("WARNING")
+
+# Trace loading
+def parse_timestamp(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+
+def load_traces(paths):
+    """Group fixes by trace/device id, each sorted by timestamp."""
+    traces = {}
+    for path in paths:
+        with open(path, newline="") as f:
+            if path.endswith(".csv"):
+                rows = csv.DictReader(f)
+            else:
+                rows = (json.loads(line) for line in f if line.strip())
+            for row in rows:
+                trace_id = row.get("trace_id") or row.get("device_id") or "default"
+                fix = {
+                    "timestamp": parse_timestamp(row["timestamp"]),
+                    "lat": float(row["lat"]),
+                    "lon": float(row["lon"]),
+                    "speed_mph": float(row.get("speed_mph") or 0),
+                    "accuracy_m": float(row["accuracy_m"]) if row.get("accuracy_m") not in (None, "") else None,
+                }
+                if row.get("home_lat") not in (None, "") and row.get("home_lon") not in (None, ""):
+                    fix["home"] = (float(row["home_lat"]), float(row["home_lon"]))
+                traces.setdefault(trace_id, []).append(fix)
+    for fixes in traces.values():
+        fixes.sort(key=lambda fix: fix["timestamp"])
+    return traces
+
+# Policies: decide(obs, previous_trend) -> (decision, path)
+class RulesPolicy:
+    def __init__(self, options):
+        self.rules = agent_main.RulePolicy(
+            home_radius=options["home_radius"],
+            precool_radius=options["precool_radius"],
+            boundary_margin=options["boundary_margin"],
+            escalate_on=options["escalate_on"],
+        )
+
+    def decide(self, obs, previous_trend):
+        decision, _, escalation = self.rules.evaluate(obs, previous_trend)
+        return decision, "rules" if escalation is None else f"rules_escalated_{escalation}"
+
+class CachedLLMPolicy:
+    """Replays logged LLM answers through the agent's DecisionCache; misses fall back to the rules."""
+
+    def __init__(self, options, hybrid):
+        self.hybrid = hybrid
+        self.rules = RulesPolicy(options)
+        self.model = agent_main.agent.model
+        self.instructions = agent_main.agent.instructions
+        self.cache = agent_main.DecisionCache(max_entries=10 ** 7, ttl=float("inf"))
+        with open(options["llm_cache"]) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    obs = agent_main.Observation.from_dict(record)
+                    self.cache.put(self.cache.key(obs, self.model, self.instructions), record["decision"])
+
+    def decide(self, obs, previous_trend):
+        decision, path = self.rules.decide(obs, previous_trend)
+        if self.hybrid and path == "rules":
+            return decision, path
+        cached = self.cache.get(self.cache.key(obs, self.model, self.instructions))
+        if cached is None:
+            return decision, "llm_cache_miss"
+        return cached, "llm_cache"
+
+class StubPolicy:
+    def __init__(self, decision):
+        self.decision = decision
+
+    def decide(self, obs, previous_trend):
+        return self.decision, "stub"
+
+def build_policy(options):
+    name = options["policy"]
+    if name == "rules":
+        return RulesPolicy(options)
+    if name in ("cached", "hybrid-cached"):
+        return CachedLLMPolicy(options, hybrid=name == "hybrid-cached")
+    if name.startswith("stub:"):
+        return StubPolicy(name.split(":", 1)[1])
+    # module:factory - factory(options) returns an object with decide(obs, previous_trend)
+    module_name, factory_name = name.split(":", 1)
+    return getattr(importlib.import_module(module_name), factory_name)(options)
+
+# Replay
+_policy = None
+_options = None
+
+def init_worker(options):
+    global _policy, _options
+    _options = options
+    _policy = build_policy(options)
+
+def simulate_trace(item):
+    """Replay one device's fixes; trips are split on gaps longer than trip_gap_minutes."""
+    trace_id, fixes = item
+    options = _options
+    home_default = tuple(options["home"])
+    trip_gap = options["trip_gap_minutes"] * 60
+    flip_window = options["flip_window_minutes"] * 60
+
+    trips = []
+    last_decision = None  # Idempotence persists across trips, as it does in the agent
+    trip = None
+    trend = None
+    previous_trend = None
+    last_timestamp = None
+
+    for fix in fixes:
+        timestamp = fix["timestamp"]
+        if trip is None or timestamp - last_timestamp > trip_gap:
+            trip = {"fixes": 0, "rejected_fixes": 0, "actuations": 0, "ac_on": 0, "ac_off": 0, "flip_flops": 0,
+                    "arrived": False, "lead_time_s": None, "paths": {}, "last_on": None, "recent_actuations": []}
+            trips.append(trip)
+            trend = agent_main.TrendEstimator(options["smoothing_seconds"], options["trend_threshold_mph"])
+            position = agent_main.PositionFilter(options["gps_filter"], options["accel_noise"], options["outlier_sigma"])
+            previous_trend = None
+        last_timestamp = timestamp
+        trip["fixes"] += 1
+
+        # As in record_location: rejected fixes skip the trend, and distance comes from the filtered position
+        accepted = position.update(timestamp, fix["lat"], fix["lon"], fix["accuracy_m"])
+        distance = agent_main.haversine(position.position(), fix.get("home", home_default))
+        if accepted:
+            trend.update(timestamp, distance)
+        else:
+            trip["rejected_fixes"] += 1
+        obs = trend.observation(distance, fix["speed_mph"], trip["fixes"])
+
+        decision, path = _policy.decide(obs, previous_trend)
+        previous_trend = obs.movement_trend
+        trip["paths"][path] = trip["paths"].get(path, 0) + 1
+
+        if decision in ("ac_on", "ac_off") and decision != last_decision:
+            # A flip-flop undoes a reversal: on -> off -> on (or the reverse) within flip_window
+            actuations = trip["recent_actuations"]
+            if len(actuations) == 2 and actuations[0][0] == decision and timestamp - actuations[0][1] <= flip_window:
+                trip["flip_flops"] += 1
+            actuations[:] = (actuations + [(decision, timestamp)])[-2:]
+            last_decision = decision
+            trip["actuations"] += 1
+            trip[decision] += 1
+            if decision == "ac_on":
+                trip["last_on"] = timestamp
+
+        if not trip["arrived"] and distance < options["home_radius"]:
+            trip["arrived"] = True
+            if last_decision == "ac_on" and trip["last_on"] is not None:
+                trip["lead_time_s"] = timestamp - trip["last_on"]
+
+    for trip in trips:
+        del trip["last_on"], trip["recent_actuations"]
+    return trace_id, trips
+
+def summarize(results, elapsed, traces, fixes):
+    trips = [trip for _, trace_trips in results for trip in trace_trips]
+    arrivals = [trip for trip in trips if trip["arrived"]]
+    lead_times = sorted(trip["lead_time_s"] / 60 for trip in arrivals if trip["lead_time_s"] is not None)
+    paths = {}
+    for trip in trips:
+        for path, count in trip["paths"].items():
+            paths[path] = paths.get(path, 0) + count
+
+    def pct(values, p):
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)] if values else None
+
+    return {
+        "traces": traces,
+        "trips": len(trips),
+        "fixes": fixes,
+        "elapsed_seconds": elapsed,
+        "traces_per_second": traces / elapsed if elapsed else None,
+        "fixes_per_second": fixes / elapsed if elapsed else None,
+        "actuations_per_trip": sum(trip["actuations"] for trip in trips) / len(trips) if trips else 0,
+        "ac_on_per_trip": sum(trip["ac_on"] for trip in trips) / len(trips) if trips else 0,
+        "flip_flops": sum(trip["flip_flops"] for trip in trips),
+        "flip_flops_per_trip": sum(trip["flip_flops"] for trip in trips) / len(trips) if trips else 0,
+        "rejected_fixes": sum(trip["rejected_fixes"] for trip in trips),
+        "arrivals": len(arrivals),
+        "precooled_arrivals": len(lead_times),
+        "precooled_rate": len(lead_times) / len(arrivals) if arrivals else None,
+        "lead_time_minutes": {
+            "mean": sum(lead_times) / len(lead_times) if lead_times else None,
+            "p10": pct(lead_times, 10),
+            "p50": pct(lead_times, 50),
+            "p90": pct(lead_times, 90),
+        },
+        "decision_paths": paths,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded location traces through the AC decision policy")
+    parser.add_argument("traces", nargs="+", help="JSONL or CSV trace files")
+    parser.add_argument("--policy", default="rules",
+                        help="rules, cached, hybrid-cached, stub:<decision> or module:factory")
+    parser.add_argument("--llm-cache", help="JSONL of logged LLM decisions (observation fields + decision)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--home-lat", type=float, default=agent_main.HOME[0])
+    parser.add_argument("--home-lon", type=float, default=agent_main.HOME[1])
+    parser.add_argument("--home-radius", type=float, default=0.25)
+    parser.add_argument("--precool-radius", type=float, default=2.0)
+    parser.add_argument("--boundary-margin", type=float, default=agent_main.RULES_BOUNDARY_MARGIN_MI)
+    parser.add_argument("--escalate-on", default=",".join(agent_main.RULES_ESCALATE_ON))
+    parser.add_argument("--smoothing-seconds", type=float, default=agent_main.TREND_SMOOTHING_SECONDS)
+    parser.add_argument("--trend-threshold-mph", type=float, default=agent_main.TREND_THRESHOLD_MPH)
+    parser.add_argument("--no-gps-filter", dest="gps_filter", action="store_false", default=agent_main.GPS_FILTER_ENABLED,
+                        help="Use raw fixes instead of the Kalman-filtered position")
+    parser.add_argument("--accel-noise", type=float, default=agent_main.GPS_ACCEL_NOISE,
+                        help="GPS filter process noise in m/s^2")
+    parser.add_argument("--outlier-sigma", type=float, default=agent_main.GPS_OUTLIER_SIGMA)
+    parser.add_argument("--trip-gap-minutes", type=float, default=agent_main.HISTORY_RETENTION_MINUTES)
+    parser.add_argument("--flip-window-minutes", type=float, default=10,
+                        help="Reversing an actuation within this window counts as a flip-flop")
+    parser.add_argument("--json", dest="json_path", help="Also write the summary as JSON to this path")
+    args = parser.parse_args()
+
+    if args.policy in ("cached", "hybrid-cached") and not args.llm_cache:
+        parser.error("--llm-cache is required for cached policies")
+
+    options = {
+        "policy": args.policy,
+        "llm_cache": args.llm_cache,
+        "home": (args.home_lat, args.home_lon),
+        "home_radius": args.home_radius,
+        "precool_radius": args.precool_radius,
+        "boundary_margin": args.boundary_margin,
+        "escalate_on": [c.strip() for c in args.escalate_on.split(",") if c.strip()],
+        "smoothing_seconds": args.smoothing_seconds,
+        "trend_threshold_mph": args.trend_threshold_mph,
+        "gps_filter": args.gps_filter,
+        "accel_noise": args.accel_noise,
+        "outlier_sigma": args.outlier_sigma,
+        "trip_gap_minutes": args.trip_gap_minutes,
+        "flip_window_minutes": args.flip_window_minutes,
+    }
+
+    traces = load_traces(args.traces)
+    fixes = sum(len(trace) for trace in traces.values())
+
+    start = time.perf_counter()
+    if args.processes <= 1:
+        init_worker(options)
+        results = [simulate_trace(item) for item in traces.items()]
+    else:
+        with ProcessPoolExecutor(max_workers=args.processes, initializer=init_worker, initargs=(options,)) as pool:
+            chunksize = max(1, len(traces) // (args.processes * 4))
+            results = list(pool.map(simulate_trace, traces.items(), chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results, elapsed, len(traces), fixes)
+    summary["policy"] = args.policy
+
+    lead = summary["lead_time_minutes"]
+    print(f"\n🧪 Simulated {summary['traces']} traces / {summary['trips']} trips / {fixes} fixes "
+          f"in {elapsed:.2f}s ({summary['traces_per_second']:.0f} traces/s) with policy '{args.policy}'")
+    print(f"   Actuations per trip: {summary['actuations_per_trip']:.2f} "
+          f"(ac_on {summary['ac_on_per_trip']:.2f}), flip-flops: {summary['flip_flops']}, "
+          f"rejected fixes: {summary['rejected_fixes']}")
+    if summary["arrivals"]:
+        print(f"   Arrivals: {summary['arrivals']}, pre-cooled: {summary['precooled_rate']:.1%}")
+    if lead["mean"] is not None:
+        print(f"   Pre-cool lead time (min): mean {lead['mean']:.1f}, p10 {lead['p10']:.1f}, "
+              f"p50 {lead['p50']:.1f}, p90 {lead['p90']:.1f}")
+    print(f"   Decision paths: {summary['decision_paths']}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()